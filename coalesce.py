@@ -0,0 +1,166 @@
+# Group commit for writes that contend for one entity group
+# Description:	While a transaction on a key is in flight, further writes to that key queue up, and all
+#				of them then go in the next transaction together instead of each contending for the
+#				entity group on its own. The transaction itself is passed in, so this module does not
+#				need the App Engine SDK.
+#				Run this file directly for a throughput harness with concurrent writers on one key.
+
+import threading
+
+
+# One write queued on a WriteCoalescer. Subclasses carry what the commit function needs
+class PendingWrite(object):
+	def __init__(self):
+		self.error = None		# Message for a refused write, set by the commit function
+		self.exception = None	# Raised if the transaction itself failed
+		self.batch = None		# Set when this write is handed the next transaction to run
+		self.ready = threading.Event()
+
+	def outcome(self):
+		if self.exception is not None:
+			raise self.exception
+		return self.error
+
+
+# Runs commit(key, batch) for batches of PendingWrites on the same key, one batch per key at a time
+class WriteCoalescer(object):
+	def __init__(self, commit):
+		self._commit_batch = commit
+		self._waiting = {}	# Key -> writes queued behind the transaction in flight
+		self._lock = threading.Lock()
+
+	# Commit write to key, returning its error message or None
+	def run(self, key, write):
+		with self._lock:
+			if key in self._waiting:
+				self._waiting[key].append(write)
+				batch = None
+			else:
+				self._waiting[key] = []
+				batch = [write]
+		if batch is None:
+			write.ready.wait()
+			if write.batch is None:
+				return write.outcome()
+			# Committed by nobody yet: this request runs the next transaction
+			batch = write.batch
+		self._commit(key, batch)
+		return write.outcome()
+
+	def _commit(self, key, batch):
+		try:
+			self._commit_batch(key, batch)
+		except BaseException as e:
+			for write in batch:
+				write.exception = e
+			raise
+		finally:
+			# Hand whatever queued up meanwhile to the first of those writes, then release this batch
+			with self._lock:
+				waiting = self._waiting.pop(key)
+				if waiting:
+					self._waiting[key] = []
+					waiting[0].batch = waiting
+			for write in batch:
+				write.ready.set()
+			if waiting:
+				waiting[0].ready.set()
+
+
+# Throughput harness: WRITERS threads each make WRITES_EACH increments to one counter behind an
+# optimistic transaction that fails when another commit lands while it runs, the way a datastore
+# entity group does. Compared with every writer running its own retried transaction. Asserts that
+# the coalesced run loses no write and that a failed transaction reaches every write in its batch.
+if __name__ == '__main__':
+	import random
+	import time
+
+	WRITERS = 20
+	WRITES_EACH = 10
+	COMMIT_LATENCY = 0.02	# Seconds between a transaction's read and its commit
+	RETRIES = 5
+	BACKOFF = 0.05
+
+	class Contention(Exception):
+		pass
+
+	# Stand-in for one entity group holding a counter
+	class EntityGroup(object):
+		def __init__(self):
+			self.value = 0
+			self.version = 0
+			self._lock = threading.Lock()
+
+		# Run one attempt at value = update(value), failing if another commit landed meanwhile
+		def transaction(self, update):
+			with self._lock:
+				version = self.version
+				value = self.value
+			value = update(value)
+			time.sleep(COMMIT_LATENCY)
+			with self._lock:
+				if self.version != version:
+					raise Contention()
+				self.value = value
+				self.version += 1
+
+		# Retry with exponential backoff and jitter, as transaction_with_backoff does
+		def transaction_with_backoff(self, update):
+			delay = BACKOFF
+			for attempt in range(RETRIES - 1):
+				try:
+					return self.transaction(update)
+				except Contention:
+					time.sleep(delay * random.uniform(0.5, 1.5))
+					delay *= 2
+			return self.transaction(update)
+
+	class Increment(PendingWrite):
+		pass
+
+	# Start WRITERS threads each running write WRITES_EACH times. Returns seconds taken and failures
+	def run_writers(write):
+		failures = []
+
+		def writer():
+			for index in range(WRITES_EACH):
+				try:
+					write()
+				except Contention as e:
+					failures.append(e)
+		threads = [threading.Thread(target=writer) for index in range(WRITERS)]
+		started = time.time()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return time.time() - started, len(failures)
+
+	total = WRITERS * WRITES_EACH
+
+	group = EntityGroup()
+	seconds, failed = run_writers(lambda: group.transaction_with_backoff(lambda value: value + 1))
+	print '%-28s %6.1f writes/s, %d of %d failed' % ('one transaction per write', (total - failed) / seconds, failed, total)
+
+	group = EntityGroup()
+	batch_sizes = []
+
+	def commit(key, batch):
+		batch_sizes.append(len(batch))
+		group.transaction_with_backoff(lambda value: value + len(batch))
+	coalescer = WriteCoalescer(commit)
+	seconds, failed = run_writers(lambda: coalescer.run('zoo', Increment()))
+	print '%-28s %6.1f writes/s, %d of %d failed, %.1f writes per transaction' % ('coalesced', (total - failed) / seconds, failed, total, float(total) / len(batch_sizes))
+	assert failed == 0, 'coalesced writes failed'
+	assert group.value == total, 'lost %d writes' % (total - group.value)
+	assert not coalescer._waiting, 'writes left queued'
+
+	# Every write in a failed batch sees the failure, and the key is usable again afterwards
+	def failing_commit(key, batch):
+		time.sleep(COMMIT_LATENCY)
+		raise Contention()
+	coalescer = WriteCoalescer(failing_commit)
+	seconds, failed = run_writers(lambda: coalescer.run('zoo', Increment()))
+	assert failed == total, 'only %d of %d writes saw their transaction fail' % (failed, total)
+	assert not coalescer._waiting, 'writes left queued after a failure'
+	print 'failed transactions reach every queued write'
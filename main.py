@@ -8,6 +8,8 @@
 #               3) The account system uses Oauth 2.0 without need of a 3rd party library
 #				4) There exists a relationship between the two entities
 #               5) Able to POST, GET, PATCH, PUT, DELETE
+#				6) Every /animals and /zoos request must send the token printed by /oauth in the
+#				Authorization header
 #				Commands of interest:
 #					/animals?checkedIn=:boolean 	-- GET request for animals that are checked in
 # 					/animals 						-- GET request will return all animals
@@ -15,29 +17,224 @@
 # 					/zoos/:zooid/animals/:animalid	-- GET request with return information of an individual animal at individual zoo
 # 					/zoos/:zooid 					-- GET request will return information of an individual zoo
 # 					/zoos 							-- GET request will return all zoos
+#					/animals:batch, /zoos:batch		-- POST request with a JSON array (or one object per line) creates up to 1000 entries
+#				/animals/:animalid and /zoos/:zooid responses carry an ETag. GET honors If-None-Match (304)
+#				and PUT/PATCH honor If-Match (412 if the entity changed in the meantime). PUT/PATCH list the
+#				fields they changed in X-Changed-Fields and write nothing if that list is empty.
+#				List requests (/animals, /zoos) return one page of at most 100 entries, 20 by default.
+#				Use ?limit=:n to pick the page size and follow the Link: rel="next" header for the next page.
+#				?fields=:a,:b on a list request returns only those fields (plus self) for each entry.
+#					/animals?since=:token, /zoos?since=:token -- GET request will return only the entries changed or
+#													deleted ({"self", "deleted": true}) since the X-Next-Since token of the last sync
+#													Entries from before the feed appear once an admin has run /tasks/backfill_updated
+#					/stats 							-- GET request will return counts of animals, checked in animals and zoos,
+#													and total population per consumption_class
 # 					/zoos/:zooid/animals/:animalid 	-- DELETE request will check a animal back in
 # 					/zoos/:zooid/animals/:animalid 	-- PUT request will check a animal out to zoo
+#				Give up to 100 animal ids separated by commas to check them in or out together.
 
 # Imported Libraries
 from google.appengine.ext import ndb
+from google.appengine.ext import deferred
+from google.appengine.ext.ndb import Cursor
 from google.appengine.api import urlfetch
+from google.appengine.api import datastore_errors
 from oauth2client.client import flow_from_clientsecrets
 from rauth.service import OAuth2Service
 import webapp2
-import json
+import jsonutil
+import coalesce
 import urllib
 import urllib2
 import string
 import random
+import logging
+import hashlib
+import time
+import threading
+import collections
+import itertools
+import datetime
 
 
-# Class to hold the secret state variable randomly generated for the user
+# Migration settings
+MIGRATION_BATCH_SIZE = 100		# Entities converted per task queue task
+
+# Keyspace settings. Zoos and animals live in their owner's entity group, under user_key(user_id).
+# They used to share the two parents below, which capped all writes at about one per second
+LEGACY_PARENTS = (ndb.Key('Animal', 'parent_animal'), ndb.Key('Zoo', 'parent_zoo'))
+LEGACY_KEYSPACE_READS = True	# Query on user_id so entities migrate_keyspace has not moved yet are found. Set to False once it has finished to use ancestor queries
+
+# Identity cache settings
+IDENTITY_CACHE_SIZE = 1024		# Max tokens remembered per instance
+IDENTITY_LOCAL_TTL = 60			# Seconds an instance trusts its own copy (bounds how long a logout takes to reach every instance)
+IDENTITY_CACHE_TTL = 600		# Seconds a token not issued by /oauth is trusted before asking Google again
+REVOKED_TOKEN_TTL = 3600		# Seconds a logged out token stays refused (Google access tokens live at most an hour)
+PEOPLE_ME_URL = 'https://www.googleapis.com/plus/v1/people/me'
+REVOKE_URL = 'https://accounts.google.com/o/oauth2/revoke'
+
+# Login settings
+OAUTH_STATE_TTL = 600			# Seconds a login has to come back to /oauth before its state is refused
+
+# Batch settings
+MAX_BATCH_SIZE = 1000			# Most items accepted by one /animals:batch or /zoos:batch request
+PUT_CHUNK_SIZE = 500			# Most entities written by one batch transaction (the datastore's own commit limit)
+IN_FILTER_LIMIT = 30			# Most values the datastore accepts in one IN filter
+MAX_CHECK_OUT_IDS = 100			# Most animal ids accepted by one /zoos/:zooid/animals/:ids check-in or check-out
+
+# Check-in/check-out settings
+TRANSACTION_RETRIES = 5			# Attempts at a contended check-in/out transaction before giving up
+TRANSACTION_BACKOFF = 0.05		# Seconds before the first retry, doubled for each one after it
+
+# Entity cache settings
+ENTITY_CACHE_TTL = 3600			# Seconds a serialized zoo or animal stays in memcache
+ENTITY_CACHE_LOCK_TTL = 10		# Seconds a write keeps readers from filling an entry unless they read after it
+
+# List cache settings
+LIST_CACHE_TTL = 600			# Seconds a rendered list page stays in memcache
+LIST_CACHE_SETTLE = 2			# Seconds after a write during which list pages are not cached, while list queries catch up
+
+# Change feed settings
+CHANGE_FEED_SETTLE = 5			# Seconds the feed stays behind now, so a write still committing with an earlier timestamp is not skipped
+
+# List pagination settings
+DEFAULT_PAGE_SIZE = 20			# Page size when ?limit= is not given
+MAX_PAGE_SIZE = 100				# Largest page the server will return, whatever ?limit= asks for
+LIST_BATCH_SIZE = 20			# Entities per datastore batch while a page is streamed out
+
+# Field projection settings. ?fields= selections that a list query can project straight from an
+# index in index.yaml. Any other selection is cut down in memory from full entities
+ANIMAL_PROJECTIONS = [frozenset(['species']), frozenset(['checked_in']), frozenset(['species', 'checked_in'])]
+CHECKED_IN_PROJECTIONS = [frozenset(['species'])]	# /animals?checkedIn=, which already filters on checked_in
+ZOO_PROJECTIONS = [frozenset(['name'])]
+
+
+# Read-through cache of the serialized JSON of single zoos and animals. Entries live in memcache
+# under the entity's key along with the owner, so only the owner is ever served the cached body.
+# Zoo and Animal hooks invalidate an entry whenever the entity is written or deleted, by leaving
+# LOCKED in its place. Readers never overwrite an entry blindly: a miss is filled with add, which
+# loses to a write committed after the reader's datastore get, and a LOCKED entry with cas, which
+# only succeeds if no other write came along since the reader saw it.
+class EntityJsonCache(object):
+	LOCKED = 'locked'
+
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+
+	# Bump the prefix whenever the JSON representation changes, so old bodies and ETags are never served
+	def _cache_key(self, key):
+		return 'json2:' + key.urlsafe()
+
+	# Start looking up the cached entry for key, remembering it for a later fill
+	def get_async(self, key):
+		return ndb.get_context().memcache_get(self._cache_key(key), for_cas=True)
+
+	# Body and ETag from a cached entry if user_id owns it, counting the hit or miss
+	def owned(self, entry, user_id):
+		with self._lock:
+			if isinstance(entry, tuple) and entry[0] == user_id:
+				self.hits += 1
+				return entry[1], entry[2]
+			self.misses += 1
+			return None
+
+	# Cache entity's body and ETag, read from the datastore after entry was looked up by get_async.
+	# Does nothing if the entity was written since
+	def fill(self, entity, body, etag, entry):
+		ctx = ndb.get_context()
+		value = (entity.user_id, body, etag)
+		if entry == self.LOCKED:
+			ctx.memcache_cas(self._cache_key(entity.key), value, time=ENTITY_CACHE_TTL)
+		elif entry is None:
+			ctx.memcache_add(self._cache_key(entity.key), value, time=ENTITY_CACHE_TTL)
+
+	# Lock key's entry once the current transaction (if any) commits. A reader that fetched the old
+	# version before then finds the lock in its way instead of the empty slot it looked up
+	def invalidate(self, key):
+		ctx = ndb.get_context()
+		ctx.call_on_commit(lambda: ctx.memcache_set(self._cache_key(key), self.LOCKED, time=ENTITY_CACHE_LOCK_TTL))
+
+	def stats(self):
+		with self._lock:
+			return {'hits': self.hits, 'misses': self.misses}
+
+
+entity_cache = EntityJsonCache()
+
+
+# Generation of a user's cached list pages: the time in ms of their last write. Every write by the
+# user moves it, which orphans all list pages cached under the previous value.
+def list_generation(user_id):
+	generation = ndb.get_context().memcache_get('listgen:' + user_id).get_result()
+	if generation is None:
+		# Lost from memcache, so start a new generation rather than risk reviving old pages
+		generation = bump_list_generation(user_id)
+	return generation
+
+
+def bump_list_generation(user_id):
+	generation = int(time.time() * 1000)
+	ndb.get_context().memcache_set('listgen:' + user_id, generation).get_result()
+	return generation
+
+
+# Class to hold the secret state variable randomly generated for the user, keyed by the state itself
 class OauthVar(ndb.Model):
-	state_var = ndb.StringProperty()
+	created = ndb.DateTimeProperty(auto_now_add=True)
 	
-# Class to hold the authentication token
+# Class to hold an authentication token, keyed by token_hash() of the bearer token so every
+# lookup is a strongly consistent get by id. ndb fronts these gets with memcache.
 class AuthToken(ndb.Model):
-	auth_token = ndb.StringProperty()
+	_use_memcache = True
+	_memcache_timeout = IDENTITY_CACHE_TTL
+	user_id = ndb.StringProperty(indexed=False)	# None for a token that was logged out
+	expires = ndb.FloatProperty(indexed=False)	# Epoch seconds after which the token must be re-verified
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# Microseconds since the epoch for a datastore timestamp, the form the change feed uses
+def epoch_us(timestamp):
+	if timestamp is None:
+		return None
+	delta = timestamp - EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_epoch_us(microseconds):
+	return EPOCH + datetime.timedelta(microseconds=microseconds)
+
+
+# Where an entity created under one of the LEGACY_PARENTS lives now. Kept in the owner's entity
+# group and keyed by the old urlsafe id, so ids issued before the move keep working
+class KeyAlias(ndb.Model):
+	target = ndb.KeyProperty(indexed=False)
+
+
+# Parent of all of a user's zoos and animals, one entity group per user
+def user_key(user_id):
+	return ndb.Key('User', user_id)
+
+
+# Whether key was issued under one of the shared LEGACY_PARENTS
+def is_legacy_key(key):
+	return key.parent() in LEGACY_PARENTS
+
+
+# Key of the alias left behind when user_id's entity at legacy_key was moved
+def alias_key(user_id, legacy_key):
+	return ndb.Key(KeyAlias, legacy_key.urlsafe(), parent=user_key(user_id))
+
+
+# Query for all of a user's zoos or animals. An ancestor query, strongly consistent, once the
+# keyspace migration is done; until then it filters on user_id so legacy entities are included
+def user_query(model, user_id):
+	if LEGACY_KEYSPACE_READS:
+		return model.query(model.user_id==user_id)
+	return model.query(ancestor=user_key(user_id))
 
 	
 # Animal class
@@ -47,6 +244,31 @@ class Animal(ndb.Model):
 	population = ndb.IntegerProperty()
 	consumption_class =  ndb.StringProperty() # Herbivore, Carnivore, Omnivore, Insectivore
 	checked_in = ndb.BooleanProperty()
+	zoo = ndb.KeyProperty(kind='Zoo')	# Zoo the animal is checked out to, mirrors Zoo.animals
+	updated = ndb.DateTimeProperty(auto_now=True)
+	version = ndb.IntegerProperty(default=0, indexed=False)	# Goes up with every write
+
+	# URL of the animal
+	def link(self):
+		return '/animals/' + self.key.urlsafe()
+
+	def _pre_put_hook(self):
+		self.version += 1
+
+	# Keep the cached JSON in step with every write
+	def _post_put_hook(self, future):
+		entity_cache.invalidate(self.key)
+
+	@classmethod
+	def _post_delete_hook(cls, key, future):
+		entity_cache.invalidate(key)
+	
+	
+# Animal as JSON dict with a self link
+animal_to_dict = jsonutil.record_serializer(
+	['user_id', 'species', 'population', 'consumption_class', 'checked_in', 'version'],
+	[('updated', lambda animal: epoch_us(animal.updated)),
+	('self', Animal.link)])
 	
 	
 # Zoo class
@@ -57,19 +279,677 @@ class Zoo(ndb.Model):
 	state = ndb.StringProperty()
 	size = ndb.StringProperty()
 	admission = ndb.FloatProperty()
-	species_list = ndb.StringProperty(repeated=True) 
+	animals = ndb.KeyProperty(kind=Animal, repeated=True)
+	species_list = ndb.StringProperty(repeated=True)	# Legacy '/animals/<urlsafe>' links, moved into animals by migrate_zoo_links
+	updated = ndb.DateTimeProperty(auto_now=True)
+	version = ndb.IntegerProperty(default=0, indexed=False)	# Goes up with every write
+
+	# URL of the zoo
+	def link(self):
+		return '/zoos/' + self.key.urlsafe()
+
+	# Keys of the animals checked out to the zoo
+	def animal_keys(self):
+		# Zoos the migration has not reached yet still carry their links as strings
+		if self.species_list:
+			return [ndb.Key(urlsafe=animals.replace('/animals/', '')) for animals in self.species_list]
+		return list(self.animals)
+
+	# Replace the zoo's animals, dropping any legacy links
+	def set_animal_keys(self, animal_keys):
+		self.animals = animal_keys
+		self.species_list = []
+
+	def _pre_put_hook(self):
+		self.version += 1
+
+	# Keep the cached JSON in step with every write
+	def _post_put_hook(self, future):
+		entity_cache.invalidate(self.key)
+
+	@classmethod
+	def _post_delete_hook(cls, key, future):
+		entity_cache.invalidate(key)
+	
+	
+# Zoo as JSON dict with a self link. species_list links are only rendered here, the entity
+# itself stores keys
+zoo_to_dict = jsonutil.record_serializer(
+	['user_id', 'name', 'city', 'state', 'size', 'admission', 'version'],
+	[('species_list', lambda zoo: ['/animals/' + k.urlsafe() for k in zoo.animal_keys()]),
+	('updated', lambda zoo: epoch_us(zoo.updated)),
+	('self', Zoo.link)])
+
+
+# Left behind by a deleted zoo or animal so the change feed can report the delete. Kept in the
+# owner's entity group and keyed by the deleted entity's urlsafe id
+class Tombstone(ndb.Model):
+	entity_kind = ndb.StringProperty()
+	link = ndb.StringProperty(indexed=False)
+	updated = ndb.DateTimeProperty(auto_now=True)
+	version = ndb.IntegerProperty(indexed=False)
+
+
+# Tombstone for entity, about to be deleted
+def tombstone_for(entity):
+	return Tombstone(key=ndb.Key(Tombstone, entity.key.urlsafe(), parent=user_key(entity.user_id)), entity_kind=entity.key.kind(), link=entity.link(), version=entity.version + 1)
+
+
+# Tombstone as JSON dict, an entry of the change feed
+def tombstone_to_dict(tombstone):
+	return {'self': tombstone.link, 'deleted': True, 'version': tombstone.version, 'updated': epoch_us(tombstone.updated)}
+
+
+# Running totals of one user's animals and zoos, keyed by user_id. Every write keeps it in step, so
+# /stats is a single get instead of a scan
+class UserStats(ndb.Model):
+	animals = ndb.IntegerProperty(default=0, indexed=False)
+	checked_in = ndb.IntegerProperty(default=0, indexed=False)
+	zoos = ndb.IntegerProperty(default=0, indexed=False)
+	population = ndb.JsonProperty()	# Total population per consumption_class
+
+	# Add counts as made by owner_stats
+	def add(self, counts):
+		population = dict(self.population or {})
+		for name, count in counts.items():
+			if name.startswith('population:'):
+				consumption_class = name[len('population:'):]
+				population[consumption_class] = population.get(consumption_class, 0) + count
+			else:
+				setattr(self, name, getattr(self, name) + count)
+		self.population = population
+
+
+# UserStats as JSON dict
+def stats_to_dict(stats):
+	stats_dict = stats.to_dict()
+	stats_dict['population'] = stats.population or {}
+	return stats_dict
+	
+	
+# Hash a bearer token so raw tokens are never stored or used as cache keys
+def token_hash(auth_token):
+	return hashlib.sha256(auth_token).hexdigest()
+
+
+# Strong ETag for a JSON representation: a hash of its exact bytes
+def json_etag(body):
+	return hashlib.sha1(body).hexdigest()
+
+
+# What entities add to their owners' UserStats: a Counter per user_id, added onto totals if given
+def owner_stats(entities, totals=None):
+	if totals is None:
+		totals = {}
+	for entity in entities:
+		if entity is None:
+			continue
+		counts = totals.setdefault(entity.user_id, collections.Counter())
+		if isinstance(entity, Zoo):
+			counts['zoos'] += 1
+		else:
+			counts['animals'] += 1
+			if entity.checked_in:
+				counts['checked_in'] += 1
+			counts['population:' + (entity.consumption_class or 'unclassified')] += entity.population or 0
+	return totals
+
+
+# Apply the difference between two owner_stats results to the owners' UserStats. Run it inside the
+# transaction that makes the change; returns the UserStats entities to put along with it
+def stats_changes(before, after):
+	deltas = {}
+	for user_id in set(before) | set(after):
+		delta = collections.Counter(after.get(user_id))
+		delta.subtract(before.get(user_id, {}))
+		if any(delta.values()):
+			deltas[user_id] = delta
+	keys = [ndb.Key(UserStats, user_id) for user_id in deltas]
+	changed = []
+	for key, stats in zip(keys, ndb.get_multi(keys)):
+		if stats is None:
+			stats = UserStats(key=key)
+		stats.add(deltas[key.id()])
+		changed.append(stats)
+	return changed
+
+
+# Whether entity exists and belongs to user_id. Mutating paths call it on the entities their
+# transaction reads anyway, rather than reading them once more beforehand just to authorize
+def owned_by(entity, user_id):
+	return entity is not None and entity.user_id == user_id
+
+
+# Whether key alone shows that user_id does not own it: keys under user_key() name their owner, so
+# another user's id is turned away before any datastore RPC. Legacy keys carry no owner and are
+# left to owned_by on the entity. None, what ApiHandler.entity_key gives for an id of the wrong
+# kind, is nobody's
+def foreign_key(key, user_id):
+	return key is None or (not is_legacy_key(key) and key.parent() != user_key(user_id))
+
+
+# Put entities and delete deleted_keys, keeping their owners' UserStats in step and leaving a
+# Tombstone for each delete. Must run inside the caller's transaction. The stored versions are
+# read past the context cache, since entities are usually those very instances, already edited.
+# Each entity's version counts on from the stored one, which the put hook then moves up by one, so
+# it goes up by exactly one per commit even if the instance was read earlier or the transaction is retried
+def put_counted(entities, deleted_keys=()):
+	entities = list(entities)
+	deleted_keys = list(deleted_keys)
+	stored = ndb.get_multi([e.key for e in entities if e.key is not None and e.key.id() is not None] + deleted_keys, use_cache=False)
+	deleted = stored[len(stored) - len(deleted_keys):]
+	stored_by_key = dict((e.key, e) for e in stored if e is not None)
+	for entity in entities:
+		if isinstance(entity, (Zoo, Animal)):
+			current = stored_by_key.get(entity.key)
+			entity.version = current.version if current is not None else 0
+	entities += stats_changes(owner_stats(stored), owner_stats(entities))
+	entities += [tombstone_for(e) for e in deleted if e is not None]
+	futures = ndb.put_multi_async(entities) + ndb.delete_multi_async(deleted_keys)
+	for future in futures:
+		future.check_success()
+
+
+# Names of the fields whose values differ between two JSON dicts of the same entity
+def changed_fields(before, after):
+	return sorted(name for name in after if after[name] != before.get(name))
+
+
+# Read the entity at key, apply edit to it and put it along with the other entities edit returns,
+# all in one xg transaction. Edits are made to the transaction's own read, so a write committed since
+# the request began (a check-out, say) is kept rather than overwritten with an older copy. If if_match
+# is given, the stored JSON representation's ETag must be in it, otherwise nothing is written and
+# PreconditionFailed is raised. Nothing is written either when the edit changes no field. Returns the
+# edited entity and the names of the changed fields, or (None, None) if user_id does not own it
+def edit_if_current(key, user_id, if_match, to_dict, edit):
+	def edit_entity():
+		entity = key.get()
+		if not owned_by(entity, user_id):
+			return None, None
+		before = to_dict(entity)
+		if if_match is not None and json_etag(jsonutil.dumps(before)) not in if_match:
+			raise PreconditionFailed()
+		others = edit(entity)
+		changed = changed_fields(before, to_dict(entity))
+		if changed:
+			put_counted([entity] + list(others))
+		return entity, changed
+	return ndb.transaction(edit_entity, xg=True)
+
+
+# Check animals out to zoo, keeping Zoo.animals and each Animal.zoo in step. Animals already
+# at another zoo are dropped from that zoo's list. zoo is updated in place; returns the other
+# entities that need to be put. Callers put everything inside one xg transaction.
+def check_out(zoo, animals):
+	animal_keys = [a.key for a in animals]
+	other_zoo_keys = set(a.zoo for a in animals if a.zoo is not None and a.zoo != zoo.key)
+	other_zoos = [z for z in ndb.get_multi(list(other_zoo_keys)) if z is not None]
+	for other_zoo in other_zoos:
+		other_zoo.set_animal_keys([k for k in other_zoo.animal_keys() if k not in animal_keys])
+
+	zoo_animals = zoo.animal_keys()
+	for animal in animals:
+		animal.zoo = zoo.key
+		animal.checked_in = False
+		if animal.key not in zoo_animals:
+			zoo_animals.append(animal.key)
+	zoo.set_animal_keys(zoo_animals)
+	return other_zoos + animals
+
+
+# Check animals back in from zoo. zoo is updated in place; returns the animals to put. An animal
+# checked out to another zoo meanwhile stays there, only dropping off this zoo's list
+def check_in(zoo, animals):
+	animal_keys = [a.key for a in animals]
+	zoo.set_animal_keys([k for k in zoo.animal_keys() if k not in animal_keys])
+	returned = [a for a in animals if a.zoo in (None, zoo.key)]
+	for animal in returned:
+		animal.zoo = None
+		animal.checked_in = True
+	return returned
+
+
+# Make animals the zoo's complete list: animals no longer listed are checked back in.
+# Returns the entities other than zoo that need to be put.
+def replace_zoo_animals(zoo, animals):
+	animal_keys = [a.key for a in animals]
+	dropped = ndb.get_multi([k for k in zoo.animal_keys() if k not in animal_keys])
+	to_put = check_in(zoo, [a for a in dropped if a is not None])
+	return to_put + check_out(zoo, animals)
+
+
+# Run fn in an xg transaction, retrying with exponential backoff and jitter when the commit loses
+# to a concurrent one. ndb's own retries come straight back, into the same collision
+def transaction_with_backoff(fn):
+	delay = TRANSACTION_BACKOFF
+	for attempt in range(TRANSACTION_RETRIES - 1):
+		try:
+			return ndb.transaction(fn, xg=True, retries=0)
+		except datastore_errors.TransactionFailedError:
+			time.sleep(delay * random.uniform(0.5, 1.5))
+			delay *= 2
+	return ndb.transaction(fn, xg=True, retries=0)
+
+
+# One request to check animals in to or out of a zoo, as queued on zoo_writes
+class ZooMembershipChange(coalesce.PendingWrite):
+	def __init__(self, user_id, animal_keys, check_out):
+		super(ZooMembershipChange, self).__init__()
+		self.user_id = user_id
+		self.animal_keys = animal_keys
+		self.check_out = check_out
+
+
+# Apply a batch of changes to one zoo inside a transaction. Each change is checked and applied in
+# turn, so a refused one leaves the others standing; sets each change's error
+def apply_zoo_changes(zoo_key, batch):
+	animal_keys = list(set(k for change in batch for k in change.animal_keys))
+	entities = ndb.get_multi([zoo_key] + animal_keys)
+	zoo = entities[0]
+	animals = dict(zip(animal_keys, entities[1:]))
+	to_put = collections.OrderedDict()
+	for change in batch:
+		change_animals = [animals[k] for k in change.animal_keys]
+		if not owned_by(zoo, change.user_id):
+			change.error = "ERROR: Unauthorized command is unable to access the zoo entity"
+		elif not all(owned_by(a, change.user_id) for a in change_animals):
+			change.error = "ERROR: Unauthorized command is unable to access the animal entity"
+		elif not change.check_out and any(k not in zoo.animal_keys() for k in change.animal_keys):
+			change.error = "ERROR: Animal is not checked out to this zoo"
+		else:
+			change.error = None
+			if change.check_out:
+				changed = check_out(zoo, change_animals)
+			else:
+				changed = check_in(zoo, change_animals)
+			for entity in [zoo] + changed:
+				to_put[entity.key] = entity
+	put_counted(to_put.values())
+
+
+# Group commit for check-ins and check-outs on this instance: changes to a zoo that queue up behind
+# a transaction in flight on it all go in the next transaction together (see coalesce.py)
+zoo_writes = coalesce.WriteCoalescer(lambda zoo_key, batch: transaction_with_backoff(lambda: apply_zoo_changes(zoo_key, batch)))
+
+
+# Find this user's animals for each species name with one IN query per IN_FILTER_LIMIT names,
+# all in flight at once. Returns a dict of species name to animal, leaving out names with no match.
+def find_animals_by_species(user_id, names):
+	names = list(set(names))
+	futures = []
+	for start in range(0, len(names), IN_FILTER_LIMIT):
+		futures.append(user_query(Animal, user_id).filter(Animal.species.IN(names[start:start + IN_FILTER_LIMIT])).fetch_async())
+	found = {}
+	for future in futures:
+		for animal in future.get_result():
+			found.setdefault(animal.species, animal)
+	return found
+
+
+# Look up the keys of the animals for a species_list, in order and without repeats. Returns the keys
+# and the names that matched none of the user's animals. Only keys are returned since the query is
+# not transactional: callers read the animals again inside the transaction that changes them
+def species_list_keys(user_id, names):
+	animals_by_species = find_animals_by_species(user_id, names)
+	animal_keys = []
+	missing = []
+	for name in names:
+		animal = animals_by_species.get(name)
+		if animal is None:
+			missing.append(name)
+		elif animal.key not in animal_keys:
+			animal_keys.append(animal.key)
+	return animal_keys, missing
+
+
+# Check one item of an /animals:batch body, returning an error message or None if it is valid
+def animal_batch_error(animal_data):
+	if not isinstance(animal_data, dict):
+		return "ERROR: Item must be a JSON object"
+	if not animal_data.get('species') or not isinstance(animal_data['species'], basestring):
+		return "ERROR: species is required"
+	if animal_data.get('population') is not None and (isinstance(animal_data['population'], bool) or not isinstance(animal_data['population'], (int, long))):
+		return "ERROR: population must be an integer"
+	if animal_data.get('consumption_class') is not None and not isinstance(animal_data['consumption_class'], basestring):
+		return "ERROR: consumption_class must be a string"
+	if animal_data.get('checked_in') is not None and not isinstance(animal_data['checked_in'], bool):
+		return "ERROR: checked_in must be true or false"
+	return None
+
+
+# Check one item of a /zoos:batch body, returning an error message or None if it is valid
+def zoo_batch_error(zoo_data):
+	if not isinstance(zoo_data, dict):
+		return "ERROR: Item must be a JSON object"
+	if not zoo_data.get('name') or not isinstance(zoo_data['name'], basestring):
+		return "ERROR: name is required"
+	for field in ('city', 'state', 'size'):
+		if zoo_data.get(field) is not None and not isinstance(zoo_data[field], basestring):
+			return "ERROR: %s must be a string" % field
+	if zoo_data.get('admission') is not None and (isinstance(zoo_data['admission'], bool) or not isinstance(zoo_data['admission'], (int, long, float))):
+		return "ERROR: admission must be a number"
+	species_list = zoo_data.get('species_list')
+	if species_list is not None and species_list != "[]":
+		if not isinstance(species_list, list) or not all(isinstance(name, basestring) for name in species_list):
+			return "ERROR: species_list must be a list of species names"
+	return None
+
+
+# Move one zoo from legacy species_list links onto Zoo.animals keys and point each animal it lists
+# that has no back-reference at it. Run inside the caller's transaction, so a check-in or
+# check-out committed meanwhile is read here rather than overwritten. Returns what was written
+def link_zoo(zoo_key):
+	zoo = zoo_key.get()
+	if zoo is None:
+		return []
+	to_put = []
+	if zoo.species_list:
+		zoo.set_animal_keys(zoo.animal_keys())
+		to_put.append(zoo)
+	orphans = [a for a in ndb.get_multi(zoo.animal_keys()) if a is not None and a.zoo is None]
+	for animal in orphans:
+		animal.zoo = zoo.key
+	ndb.put_multi(to_put + orphans)
+	return to_put + orphans
+
+
+# Run link_zoo on one page of zoos, one transaction per zoo, then queue the next page. Each page is
+# its own task, so a failed page is retried on its own and re-running the whole job only rewrites
+# what is still out of date. toplevel so the cache invalidations queued by the put hooks are flushed
+@ndb.toplevel
+def migrate_zoo_links(cursor=None):
+	start_cursor = None
+	if cursor:
+		start_cursor = Cursor(urlsafe=cursor)
+	page, next_cursor, more = Zoo.query().fetch_page(MIGRATION_BATCH_SIZE, start_cursor=start_cursor, keys_only=True)
+	written = []
+	for key in page:
+		written.extend(ndb.transaction(lambda: link_zoo(key), xg=True))
+	# Cached list pages of the owners still show what was there before
+	for user_id in set(e.user_id for e in written):
+		bump_list_generation(user_id)
+	zoos = len([e for e in written if isinstance(e, Zoo)])
+	logging.info('Migrated %d of %d zoos and %d animals in batch', zoos, len(page), len(written) - zoos)
+	if more and next_cursor:
+		deferred.defer(migrate_zoo_links, next_cursor.urlsafe())
+
+
+# Rebuild every UserStats from the entities themselves, for data written before /stats existed.
+# The first task clears them all, then each page of animals, then of zoos, is added in its own
+# task. Writes made while it runs can be counted twice, so run it before clients rely on /stats.
+@ndb.toplevel
+def rebuild_stats(kind=None, cursor=None):
+	if kind is None:
+		ndb.delete_multi(UserStats.query().fetch(keys_only=True))
+		deferred.defer(rebuild_stats, 'Animal')
+		return
+	model = Animal if kind == 'Animal' else Zoo
+	start_cursor = None
+	if cursor:
+		start_cursor = Cursor(urlsafe=cursor)
+	page, next_cursor, more = model.query().fetch_page(MIGRATION_BATCH_SIZE, start_cursor=start_cursor)
+	# One transaction per user, since each UserStats is its own entity group
+	for user_id, counts in owner_stats(page).items():
+		ndb.transaction(lambda: ndb.put_multi(stats_changes({}, {user_id: counts})))
+	logging.info('Counted %d %s entities into stats', len(page), kind)
+	if more and next_cursor:
+		deferred.defer(rebuild_stats, kind, next_cursor.urlsafe())
+	elif kind == 'Animal':
+		deferred.defer(rebuild_stats, 'Zoo')
+
+
+# Give entity a key under its owner's user_key with the same id, or a fresh one if that is taken.
+# Returns the KeyAlias that maps the old key to it, and a Tombstone that tells change feed clients
+# the old id is gone. Run inside the caller's transaction
+def move_to_user_group(entity):
+	legacy_key = entity.key
+	tombstone = tombstone_for(entity)
+	parent = user_key(entity.user_id)
+	new_key = ndb.Key(legacy_key.kind(), legacy_key.id(), parent=parent)
+	if new_key.get() is not None:
+		new_key = ndb.Key(legacy_key.kind(), type(entity).allocate_ids(size=1, parent=parent)[0], parent=parent)
+	entity.key = new_key
+	return [KeyAlias(key=alias_key(entity.user_id, legacy_key), target=new_key), tombstone]
+
+
+# Move a legacy zoo into the owner's entity group, pointing its list at the animals that have moved
+# already. Legacy animals it still lists are left to the Animal pass, whose move_animal fixes up the
+# list, so the transaction writes the same few entities however many animals the zoo has. Returns
+# the owner, the zoo's new key and the animal keys it lists, for relink_animal
+def move_zoo(zoo_key):
+	zoo = zoo_key.get()
+	if zoo is None:
+		return None, None, []
+	to_put = move_to_user_group(zoo) + [zoo]
+	animal_keys = zoo.animal_keys()
+	# Animals listed under an id that was already moved are found through their alias
+	legacy_keys = [k for k in animal_keys if is_legacy_key(k)]
+	aliases = dict((k, alias.target) for k, alias in zip(legacy_keys, ndb.get_multi([alias_key(zoo.user_id, k) for k in legacy_keys])) if alias is not None)
+	zoo.set_animal_keys([aliases.get(k, k) for k in animal_keys])
+	ndb.put_multi(to_put)
+	zoo_key.delete()
+	return zoo.user_id, zoo.key, zoo.animal_keys()
+
+
+# Point an animal's back-reference at its zoo's new key if it still names the old one. Run inside
+# the caller's transaction; returns the owner if the animal was written
+def relink_animal(animal_key, old_zoo_key, new_zoo_key):
+	animal = animal_key.get()
+	if animal is None or animal.zoo != old_zoo_key:
+		return None
+	animal.zoo = new_zoo_key
+	animal.put()
+	return animal.user_id
+
+
+# Move a legacy animal into the owner's entity group, fixing up its zoo's list if any.
+# Returns the owner
+def move_animal(animal_key):
+	animal = animal_key.get()
+	if animal is None:
+		return None
+	to_put = move_to_user_group(animal) + [animal]
+	if animal.zoo is not None:
+		zoo = animal.zoo.get()
+		if zoo is None and is_legacy_key(animal.zoo):
+			alias = alias_key(animal.user_id, animal.zoo).get()
+			if alias is not None:
+				zoo = alias.target.get()
+		if zoo is not None:
+			animal.zoo = zoo.key
+			zoo_animals = zoo.animal_keys()
+			if animal_key in zoo_animals:
+				zoo.set_animal_keys([animal.key if k == animal_key else k for k in zoo_animals])
+				to_put.append(zoo)
+	ndb.put_multi(to_put)
+	animal_key.delete()
+	return animal.user_id
+
+
+# Put entity again if it has no updated timestamp yet, inside the caller's transaction. Returns the
+# owner if it was written
+def touch_updated(key):
+	entity = key.get()
+	if entity is None or entity.updated is not None:
+		return None
+	entity.put()
+	return entity.user_id
+
+
+# Give every zoo, then every animal, written before the change feed existed an updated timestamp by
+# putting it again, one entity per transaction and one page per task. Until then ?since= never
+# returns them, even from 0: there is no index entry for a missing updated to find them by.
+# toplevel so the cache invalidations queued by the put hooks are flushed
+@ndb.toplevel
+def backfill_updated(kind='Zoo', cursor=None):
+	model = Zoo if kind == 'Zoo' else Animal
+	start_cursor = None
+	if cursor:
+		start_cursor = Cursor(urlsafe=cursor)
+	page, next_cursor, more = model.query().fetch_page(MIGRATION_BATCH_SIZE, start_cursor=start_cursor)
+	owners = set()
+	for entity in page:
+		if entity.updated is None:
+			owners.add(ndb.transaction(lambda: touch_updated(entity.key)))
+	# Cached list pages of the owners still show the entities without updated and version
+	for user_id in owners - set([None]):
+		bump_list_generation(user_id)
+	logging.info('Backfilled updated on %d of %d %s entities', len(owners - set([None])), len(page), kind)
+	if more and next_cursor:
+		deferred.defer(backfill_updated, kind, next_cursor.urlsafe())
+	elif kind == 'Zoo':
+		deferred.defer(backfill_updated, 'Animal')
+
+
+# Online move of every zoo, then every animal left, out of the LEGACY_PARENTS into per-user entity
+# groups, one entity (and its KeyAlias and Tombstone) per transaction and one page per task. Clients keep working throughout: new
+# entities are already created under user_key(), queries find both keyspaces while
+# LEGACY_KEYSPACE_READS is on, and old ids resolve through their KeyAlias. toplevel so the cache
+# invalidations queued by the put and delete hooks are flushed
+@ndb.toplevel
+def migrate_keyspace(kind='Zoo', cursor=None):
+	model, legacy_parent = (Zoo, LEGACY_PARENTS[1]) if kind == 'Zoo' else (Animal, LEGACY_PARENTS[0])
+	start_cursor = None
+	if cursor:
+		start_cursor = Cursor(urlsafe=cursor)
+	page, next_cursor, more = model.query(ancestor=legacy_parent).fetch_page(MIGRATION_BATCH_SIZE, start_cursor=start_cursor, keys_only=True)
+	owners = set()
+	for key in page:
+		if kind == 'Zoo':
+			user_id, new_key, animal_keys = ndb.transaction(lambda: move_zoo(key), xg=True)
+			owners.add(user_id)
+			# One transaction per animal, since the animals a zoo lists may belong to any number of entity groups
+			for animal_key in animal_keys:
+				owners.add(ndb.transaction(lambda: relink_animal(animal_key, key, new_key), xg=True))
+		else:
+			owners.add(ndb.transaction(lambda: move_animal(key), xg=True))
+	# The moved entities are listed under their new ids from now on
+	for user_id in owners - set([None]):
+		bump_list_generation(user_id)
+	logging.info('Moved %d legacy %s entities into user entity groups', len(page), kind)
+	if more and next_cursor:
+		deferred.defer(migrate_keyspace, kind, next_cursor.urlsafe())
+	elif kind == 'Zoo':
+		deferred.defer(migrate_keyspace, 'Animal')
 	
 	
+# Thread-safe in-process LRU cache whose entries carry their own expiry time
+class LRUCache(object):
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				return None
+			value, expires = entry
+			if expires <= time.time():
+				return None
+			# Re-insert to mark as most recently used
+			self._entries[key] = entry
+			return value
+
+	def set(self, key, value, expires):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (value, expires)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+	def delete(self, key):
+		with self._lock:
+			self._entries.pop(key, None)
+
+
+identity_cache = LRUCache(IDENTITY_CACHE_SIZE)
+
+
+# Ask Google+ which user a bearer token belongs to
+@ndb.tasklet
+def fetch_user_id_async(auth_token):
+	# GET request that uses token to access the Google+ account linked with the email login
+	try:
+		result = yield ndb.get_context().urlfetch(PEOPLE_ME_URL, headers={'Authorization': auth_token})
+	except urlfetch.Error:
+		logging.exception('Caught exception fetching url')
+		raise ndb.Return(None)
+	if result.status_code != 200:
+		raise ndb.Return(None)
+	raise ndb.Return(jsonutil.loads(result.content).get('id'))
+
+
+# Save a token in the token store along with the time it must be re-verified
+def store_auth_token_async(auth_token, user_id, expires):
+	auth_tok = AuthToken(id=token_hash(auth_token), user_id=user_id, expires=expires)
+	identity_cache.set(auth_tok.key.id(), user_id, min(expires, time.time() + IDENTITY_LOCAL_TTL))
+	return auth_tok.put_async()
+
+
+# Map a bearer token to the Google+ user ID. Lookups go in-process LRU -> token store -> people/me,
+# and no tier keeps an identity past the token's own expiry.
+@ndb.tasklet
+def resolve_user_id_async(auth_token):
+	now = time.time()
+	token_id = token_hash(auth_token)
+
+	user_id = identity_cache.get(token_id)
+	if user_id is not None:
+		raise ndb.Return(user_id)
+
+	auth_tok = yield AuthToken.get_by_id_async(token_id)
+	if auth_tok is not None:
+		if auth_tok.expires > now:
+			# Logged out: refused without asking Google, which may still accept the token
+			if auth_tok.user_id is None:
+				raise ndb.Return(None)
+			identity_cache.set(token_id, auth_tok.user_id, min(auth_tok.expires, now + IDENTITY_LOCAL_TTL))
+			raise ndb.Return(auth_tok.user_id)
+		# Expired, drop it and fall through to Google
+		auth_tok.key.delete_async()
+
+	user_id = yield fetch_user_id_async(auth_token)
+	if user_id is None:
+		raise ndb.Return(None)
+	store_auth_token_async(auth_token, user_id, now + IDENTITY_CACHE_TTL)
+	raise ndb.Return(user_id)
+
+
+# Read the bearer token from the Authorization header. Accept the raw token as well as
+# the "Bearer <token>" form printed by /oauth
+def request_token(request):
+	auth_token = request.headers.get('Authorization')
+	if not auth_token:
+		return None
+	if not auth_token.startswith('Bearer '):
+		auth_token = 'Bearer ' + auth_token
+	return auth_token
+
+
+# Log a token out: replace it in the token store with a marker that refuses it for as long as it
+# could still be valid, drop it from this instance's cache, and ask Google to revoke it. Other
+# instances stop accepting it within IDENTITY_LOCAL_TTL
+def forget_identity(auth_token):
+	token_id = token_hash(auth_token)
+	AuthToken(id=token_id, user_id=None, expires=time.time() + REVOKED_TOKEN_TTL).put()
+	identity_cache.delete(token_id)
+	try:
+		urlfetch.fetch(REVOKE_URL + '?' + urllib.urlencode({'token': auth_token[len('Bearer '):]}))
+	except urlfetch.Error:
+		logging.exception('Caught exception fetching url')
+
+
 class LogInHandler(webapp2.RequestHandler):
 	def get(self):
-		# Delete any stray state variables that may be stored
-		all_states = OauthVar.query().fetch(keys_only=True)
-		ndb.delete_multi(all_states)
-
 		# Randomly generate a string of 15 characters for the state variable
 		state_var = ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(15))
-		auth_info = OauthVar(state_var=state_var)
+		auth_info = OauthVar(id=state_var)
 		auth_info.put()
+		# Clear out the states of logins that were abandoned
+		cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=OAUTH_STATE_TTL)
+		ndb.delete_multi(OauthVar.query(OauthVar.created < cutoff).fetch(keys_only=True))
 		
 		# Send a GET request to the url with credential info
 		url = 'https://accounts.google.com/o/oauth2/v2/auth?response_type=code&client_id=518379713624-146hkku1jvqvti9o3vb3m733lav400bu.apps.googleusercontent.com&redirect_uri=https://final-project-161802.appspot.com/oauth&scope=email&state=' + state_var
@@ -88,9 +968,16 @@ class OauthHandler(webapp2.RequestHandler):
 		# Get the state variable from url returned by Google
 		returned_state = self.request.get('state')
 		# Get the stored state variable
-		state_var = OauthVar.query().get()		
+		state_var = None
+		if returned_state:
+			state_var = OauthVar.get_by_id(returned_state)
+		# A state variable is only good for one login, and only for OAUTH_STATE_TTL seconds
+		if state_var is not None:
+			state_var.key.delete()
+			if state_var.created < datetime.datetime.utcnow() - datetime.timedelta(seconds=OAUTH_STATE_TTL):
+				state_var = None
 		# If the variables match, continue 
-		if returned_state == state_var.state_var:
+		if state_var is not None:
 			# Create parameters to send in POST request
 			form_fields = {
 				'code': self.request.get('code'),
@@ -100,10 +987,6 @@ class OauthHandler(webapp2.RequestHandler):
 				'grant_type': 'authorization_code',
 			}
 			
-			# Delete any stray authentication tokens that may be stored
-			all_tokens = AuthToken.query().fetch(keys_only=True)
-			ndb.delete_multi(all_tokens)
-			
 			# POST request that exchanges the access code for a token
 			try:
 				form_data = urllib.urlencode(form_fields)
@@ -116,667 +999,858 @@ class OauthHandler(webapp2.RequestHandler):
 			except urlfetch.Error:
 				logging.exception('Caught exception fetching url')	
 			# Store and obtain token
-			token_results = json.loads(result.content)
+			token_results = jsonutil.loads(result.content)
 			auth_token = "Bearer " + token_results.get('access_token')
 			self.response.write("Obtained token: ")	
 			self.response.write(auth_token)
 			
-			# Store token in dict
-			auth_tok = AuthToken(auth_token=auth_token)
-			auth_tok.put()
+			# Store token along with when it expires
+			user_id = fetch_user_id_async(auth_token).get_result()
+			if user_id is not None:
+				expires = time.time() + token_results.get('expires_in', IDENTITY_CACHE_TTL)
+				store_auth_token_async(auth_token, user_id, expires).get_result()
 		
 		
-class AnimalHandler(webapp2.RequestHandler):
-	# POST data in order to make a new Animal
-	def post(self):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
+# Raised when the caller's token does not resolve to a user
+class NotAuthorized(Exception):
+	pass
+
+
+# Raised when an If-Match precondition does not hold
+class PreconditionFailed(Exception):
+	pass
+
+
+# Base handler for the REST resources. Starts resolving the caller from the Authorization header
+# as soon as the request arrives, without waiting on it, and verbs only block when they read
+# self.user_id. Single-entity GETs look up the entity cache in the meantime. Datastore reads of
+# zoos and animals wait for the caller first, so an id in another user's entity group is refused
+# from its key before any RPC is spent on it.
+class ApiHandler(webapp2.RequestHandler):
+	@ndb.toplevel
+	def dispatch(self):
+		started = time.time()
+		self.identity_wait = 0.0
+		self.wrote_nothing = False
+		self._user_future = None
+		auth_token = request_token(self.request)
+		if auth_token:
+			self._user_future = resolve_user_id_async(auth_token)
+		try:
+			# Short-circuit before any datastore work if there is no token at all
+			if self._user_future is None:
+				raise NotAuthorized()
+			super(ApiHandler, self).dispatch()
+			# Any successful write by the user invalidates their cached list pages
+			if self.request.method != 'GET' and self.response.status_int < 400 and not self.wrote_nothing:
+				bump_list_generation(self.user_id)
+		except NotAuthorized:
+			self.response.clear()
+			self.response.set_status(401)
 			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
-			
-			# Set up ancestor Animal that will be parent of all Animal
-			parent_key = ndb.Key(Animal, "parent_animal")
-			# Send data into json obj
-			animal_data = json.loads(self.request.body) 
-			# Create new Animal
-			new_animal = Animal(user_id=user_id, species=animal_data['species'], population=animal_data['population'], consumption_class=animal_data['consumption_class'], checked_in=animal_data['checked_in'], parent=parent_key)
-			new_animal.put()
-			animal_dict = new_animal.to_dict()
-			animal_dict['self'] = '/animals/' + new_animal.key.urlsafe()
-			# Dump data back out
-			self.response.write(json.dumps(animal_dict)) 
+		except PreconditionFailed:
+			self.response.clear()
+			self.response.set_status(412)
+			self.response.write("ERROR: Entity has changed since the ETag in If-Match")
+		# Per-handler latency, and how much of it was spent blocked on the identity lookup
+		logging.info('%s %s: %.1f ms total, %.1f ms waiting on identity', self.request.method, self.__class__.__name__, (time.time() - started) * 1000, self.identity_wait * 1000)
+
+	# The caller's user ID. Blocks until the identity lookup finishes and raises NotAuthorized if
+	# the token was rejected
+	@property
+	def user_id(self):
+		waited = time.time()
+		user_id = self._user_future.get_result()
+		self.identity_wait += time.time() - waited
+		if user_id is None:
+			raise NotAuthorized()
+		return user_id
+
+	# Key for a zoo or animal id from the request path, or None if the id is not one of model's, so
+	# a zoo id is never served or written as an animal (nor any other kind as either). An id issued
+	# under the LEGACY_PARENTS is looked up among the caller's aliases in case migrate_keyspace has
+	# moved it. Other ids cost no RPC
+	def entity_key(self, urlsafe, model):
+		key = ndb.Key(urlsafe=urlsafe)
+		if key.kind() != model._get_kind():
+			return None
+		if is_legacy_key(key):
+			alias = alias_key(self.user_id, key).get()
+			if alias is not None:
+				return alias.target
+		return key
+
+	# The caller's model entity with the given id, or None if there is none. An id of another kind or
+	# in another user's entity group is refused from its key alone, without reading anything
+	def get_owned(self, urlsafe, model):
+		key = self.entity_key(urlsafe, model)
+		user_id = self.user_id
+		if foreign_key(key, user_id):
+			return None
+		entity = key.get()
+		if not owned_by(entity, user_id):
+			return None
+		return entity
+
+	# Write the caller's zoos or animals changed since ?since=, oldest first, with deleted ones as
+	# tombstones. since is the X-Next-Since value of the previous response, in microseconds since the
+	# epoch. Entries at exactly that time are sent again, so clients must apply them idempotently.
+	def write_changes(self, model, to_dict):
+		try:
+			since = from_epoch_us(int(self.request.get('since')))
+			limit = int(self.request.get('limit') or DEFAULT_PAGE_SIZE)
+		except (ValueError, OverflowError):
+			self.response.set_status(400)
+			self.response.write("ERROR: Invalid since or limit")
+			return
+		if limit < 1:
+			self.response.set_status(400)
+			self.response.write("ERROR: Invalid since or limit")
+			return
+		limit = min(limit, MAX_PAGE_SIZE)
+
+		user_id = self.user_id
+		until = datetime.datetime.utcnow() - datetime.timedelta(seconds=CHANGE_FEED_SETTLE)
+		changed = user_query(model, user_id).filter(model.updated >= since, model.updated <= until).order(model.updated).fetch_async(limit)
+		deleted = Tombstone.query(Tombstone.entity_kind==model._get_kind(), Tombstone.updated >= since, Tombstone.updated <= until, ancestor=user_key(user_id)).order(Tombstone.updated).fetch_async(limit)
+		entries = sorted(changed.get_result() + deleted.get_result(), key=lambda entry: entry.updated)[:limit]
+
+		# A full page may have more behind it, which starts where this one stopped
+		next_since = max(since, until)
+		if len(entries) == limit:
+			next_since = entries[-1].updated
+			params = [(k.encode('utf-8'), v.encode('utf-8')) for k, v in self.request.GET.items() if k not in ('limit', 'since')]
+			params += [('limit', limit), ('since', epoch_us(next_since))]
+			self.response.headers['Link'] = '<%s?%s>; rel="next"' % (self.request.path_url, urllib.urlencode(params))
+		self.response.headers['X-Next-Since'] = str(epoch_us(next_since))
+		self.write_json_list(entries, lambda entry: tombstone_to_dict(entry) if isinstance(entry, Tombstone) else to_dict(entry))
+
+	# Write one page of a list query. ?limit= sets the page size (capped at MAX_PAGE_SIZE) and
+	# ?cursor= takes the opaque token from the previous page's Link: <...>; rel="next" header
+	def write_page(self, query, to_dict, projections=()):
+		try:
+			limit = int(self.request.get('limit') or DEFAULT_PAGE_SIZE)
+			cursor = None
+			if self.request.get('cursor'):
+				cursor = Cursor(urlsafe=self.request.get('cursor'))
+		except (ValueError, datastore_errors.BadValueError):
+			self.response.set_status(400)
+			self.response.write("ERROR: Invalid limit or cursor")
+			return
+		if limit < 1:
+			self.response.set_status(400)
+			self.response.write("ERROR: Invalid limit or cursor")
+			return
+		limit = min(limit, MAX_PAGE_SIZE)
+
+		# ?fields=a,b limits each entry to those fields; 'self' is always included
+		fields = None
+		if self.request.get('fields'):
+			requested = set(name.strip() for name in self.request.get('fields').split(','))
+			requested.discard('')
+			unknown = requested.difference(to_dict.fields)
+			if unknown:
+				self.response.set_status(400)
+				self.response.write("ERROR: Unknown fields: " + ", ".join(sorted(unknown)))
+				return
+			fields = [name for name in to_dict.fields if name in requested or name == 'self']
+
+		# Serve the page from the user's list cache if nothing was written since it was rendered
+		user_id = self.user_id
+		generation = list_generation(user_id)
+		request_params = sorted((k.encode('utf-8'), v.encode('utf-8')) for k, v in self.request.GET.items())
+		cache_key = 'list:%s:%s' % (user_id, hashlib.sha1('%d %s?%s' % (generation, self.request.path, urllib.urlencode(request_params))).hexdigest())
+		cached = ndb.get_context().memcache_get(cache_key).get_result()
+		if cached is not None:
+			body, link = cached
+			if link:
+				self.response.headers['Link'] = link
+			self.response.headers['X-Cache'] = 'HIT'
+			self.response.write(body)
+			return
+
+		options = {}
+		if fields is not None:
+			stored = [name for name in fields if name != 'self']
+			if frozenset(stored) in projections:
+				# An index covers the selection, so the datastore returns only those properties
+				options['projection'] = stored
+				to_dict = jsonutil.record_serializer(stored, [('self', lambda entity: entity.link())])
+			else:
+				to_dict = jsonutil.field_selector(to_dict, fields)
+
+		# Stream the page out as the query's batches arrive. Ask for one extra result so the
+		# iterator knows whether there is a next page, the way fetch_page does
+		entities = query.iter(limit=limit + 1, start_cursor=cursor, batch_size=min(limit, LIST_BATCH_SIZE), produce_cursors=True, **options)
+		self.response.headers['X-Cache'] = 'MISS'
+		self.write_json_list(itertools.islice(entities, limit), to_dict)
+		try:
+			next_cursor = entities.cursor_after()
+		except datastore_errors.BadArgumentError:
+			next_cursor = None
+		if next_cursor and entities.probably_has_next():
+			params = [(k.encode('utf-8'), v.encode('utf-8')) for k, v in self.request.GET.items() if k not in ('limit', 'cursor')]
+			params += [('limit', limit), ('cursor', next_cursor.urlsafe())]
+			self.response.headers['Link'] = '<%s?%s>; rel="next"' % (self.request.path_url, urllib.urlencode(params))
+		# Right after a write the list query may not reflect it yet, so don't cache that page
+		if time.time() * 1000 - generation >= LIST_CACHE_SETTLE * 1000:
+			ndb.get_context().memcache_set(cache_key, (self.response.body, self.response.headers.get('Link')), time=LIST_CACHE_TTL)
+
+	# Write a JSON representation with a strong ETag. A GET whose If-None-Match already names
+	# that ETag gets a 304 with no body instead
+	def write_json(self, data):
+		body = jsonutil.dumps(data)
+		self.write_body(body, json_etag(body))
+
+	# Write an already serialized JSON body with its ETag, see write_json
+	def write_body(self, body, etag):
+		self.response.headers['ETag'] = '"%s"' % etag
+		if self.request.method in ('GET', 'HEAD') and etag in self.request.if_none_match:
+			self.response.set_status(304)
+			return
+		self.response.write(body)
+
+	# Serve a single zoo or animal owned by the caller, from the JSON cache when possible. Returns
+	# False, having written nothing, if the entity is not the caller's or key is None
+	def write_cached_entity(self, key, to_dict):
+		if key is None:
+			return False
+		cached = entity_cache.get_async(key)
+		# Wait for the caller's identity while the cache lookup is in flight
+		user_id = self.user_id
+		entry = cached.get_result()
+		hit = entity_cache.owned(entry, user_id)
+		if hit is not None:
+			self.response.headers['X-Cache'] = 'HIT'
+			self.write_body(*hit)
+			return True
+
+		if foreign_key(key, user_id):
+			return False
+		entity = key.get()
+		if not owned_by(entity, user_id):
+			return False
+		body = jsonutil.dumps(to_dict(entity))
+		etag = json_etag(body)
+		entity_cache.fill(entity, body, etag, entry)
+		self.response.headers['X-Cache'] = 'MISS'
+		self.write_body(body, etag)
+		return True
+
+	# Apply edit to the caller's zoo or animal with the given id inside a transaction, honoring
+	# If-Match, and put it unless the edit changes nothing: clients resend whole objects, and a no-op
+	# write would still cost a put and drop the caches. The changed field names go in the
+	# X-Changed-Fields header, empty when the write was skipped. Returns the edited entity, or None
+	# if the caller has no such entity. An id of another kind than model, or in another user's
+	# entity group, is refused from its key
+	def save_edit(self, urlsafe, model, to_dict, edit):
+		key = self.entity_key(urlsafe, model)
+		user_id = self.user_id
+		if foreign_key(key, user_id):
+			return None
+		if_match = None
+		if 'If-Match' in self.request.headers:
+			if_match = self.request.if_match
+		entity, changed = edit_if_current(key, user_id, if_match, to_dict, edit)
+		if entity is None:
+			return None
+		self.response.headers['X-Changed-Fields'] = ', '.join(changed)
+		if not changed:
+			self.wrote_nothing = True
+		return entity
+
+	# Parse a batch body: a JSON array, or NDJSON with one JSON object per line. Writes the error
+	# and returns None if the body is malformed or holds more than MAX_BATCH_SIZE items
+	def read_batch(self):
+		body = self.request.body.strip()
+		try:
+			if body.startswith('['):
+				items = jsonutil.loads(body)
+			else:
+				items = [jsonutil.loads(line) for line in body.splitlines() if line.strip()]
+		except ValueError:
+			self.response.set_status(400)
+			self.response.write("ERROR: Batch must be a JSON array or one JSON object per line")
+			return None
+		if not items:
+			self.response.set_status(400)
+			self.response.write("ERROR: Batch is empty")
+			return None
+		if len(items) > MAX_BATCH_SIZE:
+			self.response.set_status(413)
+			self.response.write("ERROR: Batch is larger than %d items" % MAX_BATCH_SIZE)
+			return None
+		return items
+
+	# Wait for a batch write and report a status per item. item_entities holds, for each item, the
+	# entity to link to followed by any other entities written on its behalf. Responds 201 when
+	# every item was written, 207 otherwise.
+	def write_batch_results(self, item_entities, futures_by_entity, self_prefix):
+		results = []
+		for index, entities in enumerate(item_entities):
+			failed = False
+			for entity in entities:
+				if futures_by_entity[id(entity)].get_exception() is not None:
+					failed = True
+			if failed:
+				results.append({'index': index, 'status': 500, 'error': "ERROR: Write failed"})
+			else:
+				results.append({'index': index, 'status': 201, 'self': self_prefix + entities[0].key.urlsafe()})
+		if all(result['status'] == 201 for result in results):
 			self.response.set_status(201)
+		else:
+			self.response.set_status(207)
+		self.response.write(jsonutil.dumps(results))
+
+	# Write entities out as a JSON array one element at a time. Works on any iterable, including a
+	# query iterator, so only one batch of entities and one encoded element are held at a time
+	def write_json_list(self, entities, to_dict):
+		self.response.write('[')
+		first = True
+		for entity in entities:
+			if not first:
+				self.response.write(', ')
+			first = False
+			self.response.write(jsonutil.dumps(to_dict(entity)))
+		self.response.write(']')
+
+
+class AnimalHandler(ApiHandler):
+	# POST data in order to make a new Animal
+	def post(self):
+		# Caller was resolved from the Authorization header in dispatch()
+		user_id = self.user_id
+		
+		# The user's own entity group is the parent of all their animals
+		parent_key = user_key(user_id)
+		# Send data into json obj
+		animal_data = jsonutil.loads(self.request.body) 
+		# Create new Animal
+		new_animal = Animal(user_id=user_id, species=animal_data['species'], population=animal_data['population'], consumption_class=animal_data['consumption_class'], checked_in=animal_data['checked_in'], parent=parent_key)
+		ndb.transaction(lambda: put_counted([new_animal]), xg=True)
+		animal_dict = animal_to_dict(new_animal)
+		# Dump data back out
+		self.response.write(jsonutil.dumps(animal_dict)) 
+		self.response.set_status(201)
 		
 	# GET data for animals
 	def get(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
-		
-			checkedIn_val = self.request.get('checkedIn')
-			if id:
-				# GET request for information of an individual animal
-				b = ndb.Key(urlsafe=id).get()
-				if b.user_id == user_id:
-					b_d = b.to_dict()
-					# Create a self link using the key as id
-					b_d['self'] = "/animals/"+id
-					self.response.write(json.dumps(b_d))
-				else:
-					self.response.write("ERROR: Not authorized")
+		checkedIn_val = self.request.get('checkedIn')
+		if id:
+			# GET request for information of an individual animal
+			if not self.write_cached_entity(self.entity_key(id, Animal), animal_to_dict):
+				self.response.write("ERROR: Not authorized")
 
-			# GET request for all animals
-			if (id == None and not checkedIn_val):
-			
-				all_animals = Animal.query(Animal.user_id==user_id).fetch()
-				final_list = []
-				for animals in all_animals:
-					json_animals = animals.to_dict()
-					json_animals['self'] = '/animals/' + animals.key.urlsafe()
-					final_list.append(json_animals)
-				self.response.write(json.dumps(final_list))
-		
-			else:
-				# Use GET multidict to find query variable
-				# /animals?checkedIn=:boolean -- GET request for checkedIn=TRUE animals
-				#if checkedIn_boolean is True:
-				if checkedIn_val=="true":
-					user_animals = Animal.query(Animal.user_id==user_id).fetch()
-					final_list = []
-					for animals in user_animals:
-						if animals.checked_in == True:
-							json_animal = animals.to_dict()
-							json_animal['self'] = '/animals/' + animals.key.urlsafe()
-							final_list.append(json_animal)
-					self.response.write(json.dumps(final_list))
-
-				# /animals?checkedIn=:boolean -- GET request for checkedIn=FALSE animals
-				#if checkedIn_boolean is False:
-				if checkedIn_val=="false":
-					user_animals = Animal.query(Animal.user_id==user_id).fetch()
-					final_list = []
-					for animals in user_animals:
-						if animals.checked_in == False:
-							json_animal = animals.to_dict()
-							json_animal['self'] = '/animals/' + animals.key.urlsafe()
-							final_list.append(json_animal)
-					self.response.write(json.dumps(final_list))
+		# /animals?since=:token -- GET request will return the animals changed or deleted since then
+		elif self.request.get('since'):
+			self.write_changes(Animal, animal_to_dict)
+
+		# GET request for all animals
+		elif checkedIn_val in ("", "true", "false"):
+			user_id = self.user_id
+			query = user_query(Animal, user_id)
+			projections = ANIMAL_PROJECTIONS
+			# /animals?checkedIn=:boolean -- filter in the datastore using the (user_id, checked_in) index
+			if checkedIn_val:
+				query = query.filter(Animal.checked_in==(checkedIn_val=="true"))
+				projections = CHECKED_IN_PROJECTIONS
+			self.write_page(query, animal_to_dict, projections)
+
+		else:
+			self.response.set_status(400)
+			self.response.write("ERROR: checkedIn must be true or false")
 				
 	# DELETE animal entries
 	def delete(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
-	
-			if id:
-				# Retrieve entity
-				a = ndb.Key(urlsafe=id).get()	
-				if a.user_id == user_id:
-					# Delete the animal from Animal
-					a.key.delete()		
+		if id:
+			animal_key = self.entity_key(id, Animal)
+			user_id = self.user_id
+			# Delete the animal and drop it from the zoo it is checked out to, found through its
+			# back-reference, in one transaction. Ownership is checked on the transaction's read
+			def delete_animal():
+				animal = animal_key.get()
+				if animal is None:
+					return True
+				if not owned_by(animal, user_id):
+					return False
+				to_put = []
+				if animal.zoo is not None:
+					zoo = animal.zoo.get()
+					if zoo is not None:
+						check_in(zoo, [animal])
+						to_put.append(zoo)
+				put_counted(to_put, [animal.key])
+				return True
+			# Another user's id is refused from the key alone, before the transaction
+			if not foreign_key(animal_key, user_id) and ndb.transaction(delete_animal, xg=True):
+				# Set code 204
+				self.response.set_status(204)
+			else:
+				self.response.write("ERROR: Unauthorized command")
 			
-					# Delete animal from any zoo species_list lists
-					a_id = "/animals/"+id 							# = "/books/aghkZXZ-Tm9uZXImCxIEQm9vayILcGFyZW50X2Jvb2sMCxIEQm9vaxiAgICAgPSeCAw"
-					zoo = Zoo.query(Zoo.species_list==a_id).get()	# = Customer(key=Key('Customer', 'parent_customer', 'Customer', 5074933356953600), balance=3.5, checked_out=[u'/book/aghkZXZ-Tm9uZXImCxIEQm9vayILcGFyZW50X2Jvb2sMCxIEQm9vaxiAgICAgPSeCAw', u'/book/aghkZXZ-Tm9uZXImCxIEQm9vayILcGFyZW50X2Jvb2sMCxIEQm9vaxiAgICAgPSuCww'], name=u'Dennis Howard')
-		#			self.response.write(zoo.species_list)			# = [u'/animals/aghkZXZ-Tm9uZXImCxIEQm9vayILcGFyZW50X2Jvb2sMCxIEQm9vaxiAgICAgMymCQw', u'/book/aghkZXZ-Tm9uZXImCxIEQm9vayILcGFyZW50X2Jvb2sMCxIEQm9vaxiAgICAgMzmCww']
-					if zoo:
-						zoo.species_list.remove(a_id)
-						zoo.put()
-					# Set code 204
-					self.response.set_status(204)
-				else:
-					self.response.write("ERROR: Unauthorized command")
-				
 	# PUT animal entries
 	def put(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
+		if id:
+			# Send data into json obj
+			animal_data = jsonutil.loads(self.request.body)
 			
-			if id:
-				# Retrieve entity
-				a = ndb.Key(urlsafe=id).get()
-				if a.user_id == user_id:
-					# Send data into json obj
-					animal_data = json.loads(self.request.body)
-					
-					# If there is a species, update
-					if animal_data.get('species'):
-						a.species=animal_data['species']
-					# Else fill as NULL
-					else:
-						a.species=None
-						
-					# If there is a population, update
-					if animal_data.get('population'):
-						a.population=animal_data['population']
-					# Else fill as NULL
-					else:
-						a.population=None
-						
-					# If there is a consumption_class, update
-					if animal_data.get('consumption_class'):
-						a.consumption_class=animal_data['consumption_class']
-					# Else fill as NULL
-					else:
-						a.consumption_class=None
-					
-					# If there is a checked_in, update
-					if animal_data.get('checked_in'):
-						a.checked_in=animal_data['checked_in']
-					# Else fill as NULL
-					else:
-						a.checked_in=False
+			# Edits to the animal as the transaction reads it
+			def edit(a):
+				# If there is a species, update
+				if animal_data.get('species'):
+					a.species=animal_data['species']
+				# Else fill as NULL
+				else:
+					a.species=None
 					
-					# Put edits into animal
-					a.put()
-					a_dict = a.to_dict()
-					a_dict['self'] = '/animals/' + a.key.urlsafe()
-					# Dump data back out
-					self.response.write(json.dumps(a_dict))
+				# If there is a population, update
+				if animal_data.get('population'):
+					a.population=animal_data['population']
+				# Else fill as NULL
+				else:
+					a.population=None
 					
+				# If there is a consumption_class, update
+				if animal_data.get('consumption_class'):
+					a.consumption_class=animal_data['consumption_class']
+				# Else fill as NULL
+				else:
+					a.consumption_class=None
+				
+				# If there is a checked_in, update
+				if animal_data.get('checked_in'):
+					a.checked_in=animal_data['checked_in']
+				# Else fill as NULL
 				else:
-					self.response.write("ERROR: Unauthorized command")
+					a.checked_in=False
+				return []
+			
+			# Put edits into the caller's animal, unless they change nothing or If-Match no longer holds
+			a = self.save_edit(id, Animal, animal_to_dict, edit)
+			if a is not None:
+				# Dump data back out
+				self.write_json(animal_to_dict(a))
 				
+			else:
+				self.response.write("ERROR: Unauthorized command")
+			
 	# PATCH animal entries
 	def patch(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
+		if id:
+			# Send data into json obj
+			animal_data = jsonutil.loads(self.request.body)
 			
-			if id:
-				# Retrieve entity
-				a = ndb.Key(urlsafe=id).get()
-				if a.user_id == user_id:
-					# Send data into json obj
-					animal_data = json.loads(self.request.body)
+			# Edits to the animal as the transaction reads it
+			def edit(a):
+				# If there is a species, update
+				if animal_data.get('species'):
+					a.species=animal_data['species']
 					
-					# If there is a species, update
-					if animal_data.get('species'):
-						a.species=animal_data['species']
-						
-					# If there is a population, update
-					if animal_data.get('population'):
-						a.population=animal_data['population']
-						
-					# If there is a consumption_class, update
-					if animal_data.get('consumption_class'):
-						a.consumption_class=animal_data['consumption_class']
+				# If there is a population, update
+				if animal_data.get('population'):
+					a.population=animal_data['population']
 					
-					# If there is a checked_in, update
-					if animal_data.get('checked_in'):
-						a.checked_in=animal_data['checked_in']
+				# If there is a consumption_class, update
+				if animal_data.get('consumption_class'):
+					a.consumption_class=animal_data['consumption_class']
+				
+				# If there is a checked_in, update
+				if animal_data.get('checked_in'):
+					a.checked_in=animal_data['checked_in']
 		#			if animal_data.get('checked_in')==False:		###########
 		#				a.checked_in=False							###########
-					else:											###########
-						a.checked_in=False
-					
-					# Put edits into animal
-					a.put()
-					a_dict = a.to_dict()
-					a_dict['self'] = '/animals/' + a.key.urlsafe()
-					# Dump data back out
-					self.response.write(json.dumps(a_dict))
-					
-				else:
-					self.response.write("ERROR: Unauthorized command")
-					
+				else:											###########
+					a.checked_in=False
+				return []
+			
+			# Put edits into the caller's animal, unless they change nothing or If-Match no longer holds
+			a = self.save_edit(id, Animal, animal_to_dict, edit)
+			if a is not None:
+				# Dump data back out
+				self.write_json(animal_to_dict(a))
 				
-class ZooHandler(webapp2.RequestHandler):
+			else:
+				self.response.write("ERROR: Unauthorized command")
+				
+			
+class ZooHandler(ApiHandler):
+	# Check the animals of a ':zooid/animals/:animalid,...' id out to the zoo, or back in from it,
+	# in a transaction shared with any other check-ins or check-outs queued on the zoo
+	def change_membership(self, id, check_out):
+		# Split id to obtain the zoo id and animal ids, several animals may be given separated by commas
+		id_list = id.split("/animals/")
+		z_id = id_list[0]
+		a_ids = id_list[1].split(",")
+		# Every id is read in one transaction, so the list is capped like a batch body
+		if len(a_ids) > MAX_CHECK_OUT_IDS:
+			self.response.set_status(413)
+			self.response.write("ERROR: More than %d animal ids" % MAX_CHECK_OUT_IDS)
+			return
+		# Retrieve keys of the zoo and animals
+		zoo_key = self.entity_key(z_id, Zoo)
+		animal_keys = [self.entity_key(a_id, Animal) for a_id in a_ids]
+		user_id = self.user_id
+		# Another user's ids are refused from the keys alone, before the transaction
+		if foreign_key(zoo_key, user_id):
+			error = "ERROR: Unauthorized command is unable to access the zoo entity"
+		elif any(foreign_key(k, user_id) for k in animal_keys):
+			error = "ERROR: Unauthorized command is unable to access the animal entity"
+		else:
+			error = zoo_writes.run(zoo_key, ZooMembershipChange(user_id, animal_keys, check_out))
+		if error:
+			self.response.write(error)
+		elif check_out:
+			self.response.set_status(201)
+		else:
+			self.response.set_status(200)
+
 	# POST data in order to make a new zoo
 	def post(self):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
+		# Caller was resolved from the Authorization header in dispatch()
+		user_id = self.user_id
 		
-			# Set up ancestor zoo that will be parent of all zoos
-			parent_key = ndb.Key(Zoo, "parent_zoo")
-			# Send data into json obj
-			zoo_data = json.loads(self.request.body)
-			# Create list to hold animals links in species_list
-			zoo_animals = []
-			if zoo_data['species_list']=="[]":
-				# Create a new zoo
-				new_zoo = Zoo(user_id=user_id, name=zoo_data['name'], city=zoo_data['city'], state=zoo_data['state'], size=zoo_data['size'], admission=zoo_data['admission'], species_list=zoo_animals, parent=parent_key)
-			else:
-				# Loop through all species_list animals passed in POST request
-				for animals in zoo_data['species_list']:
-					# Match species_list animals with list of animals in database
-					animal_list = Animal.query(Animal.species==animals).get()
-					# Adjust Animals list of checked_in to be consistent with species_list
-					animal_list.checked_in=False	
-					animal_list.put()				
-					# Add the animal link to zoo_animals
-					zoo_animals.append('/animals/' + animal_list.key.urlsafe())
-				# Create a new zoo
-				new_zoo = Zoo(user_id=user_id, name=zoo_data['name'], city=zoo_data['city'], state=zoo_data['state'], size=zoo_data['size'], admission=zoo_data['admission'], species_list=zoo_animals, parent=parent_key)
-
-			new_zoo.put()
-			zoo_dict = new_zoo.to_dict()
-			zoo_dict['self'] = '/zoos/' + new_zoo.key.urlsafe()	
-			# Dump data back out
-			self.response.write(json.dumps(zoo_dict))
-			self.response.set_status(201)
-					
+		# The user's own entity group is the parent of all their zoos
+		parent_key = user_key(user_id)
+		# Send data into json obj
+		zoo_data = jsonutil.loads(self.request.body)
+		# Create list to hold the keys of the animals named in species_list
+		animal_keys = []
+		if zoo_data['species_list']!="[]":
+			# Match species_list animals with the user's animals in one batched query
+			animal_keys, missing = species_list_keys(user_id, zoo_data['species_list'])
+			if missing:
+				self.response.set_status(400)
+				self.response.write("ERROR: No animal of species: " + ", ".join(missing))
+				return
+		# Create a new zoo, allocating its key up front so the animals can point back at it
+		zoo_id = Zoo.allocate_ids(size=1, parent=parent_key)[0]
+		new_zoo = Zoo(user_id=user_id, name=zoo_data['name'], city=zoo_data['city'], state=zoo_data['state'], size=zoo_data['size'], admission=zoo_data['admission'], id=zoo_id, parent=parent_key)
+		# Read the animals, check them out to the zoo and insert it in one transaction
+		def create_zoo():
+			zoo_animals = [a for a in ndb.get_multi(animal_keys) if owned_by(a, user_id)]
+			put_counted([new_zoo] + check_out(new_zoo, zoo_animals))
+		ndb.transaction(create_zoo, xg=True)
+		zoo_dict = zoo_to_dict(new_zoo)
+		# Dump data back out
+		self.response.write(jsonutil.dumps(zoo_dict))
+		self.response.set_status(201)
+				
 	# GET data for zoos
 	def get(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
-		
-			# If there is an id
-			if id:
-				# /zoo/:zooid/animals -- GET request will return an array of full JSON animals entries
-				if id.endswith("/animals"):
-					z_id = id.replace("/animals", "")
-					z = ndb.Key(urlsafe=z_id).get()
-					if z.user_id == user_id:
-						final_list = []
-						all_animals = Animal.query().fetch()
-						for animals in all_animals:
-							a_id = '/animals/' + animals.key.urlsafe()
-							for z_animals in z.species_list:
-								if a_id == z_animals:
-									json_animals = animals.to_dict()
-									json_animals['self'] = '/animals/' + animals.key.urlsafe()
-									final_list.append(json_animals)
-						self.response.write(json.dumps(final_list))
-					else:
-						self.response.write("ERROR: Not authorized")
-					
-				# /zoos/:zooid/animals/:animalid
-				elif "/animals/" in id:
-					# Split id to obtain the zoo id and animal id
-					id_list = id.split("/animals/")
-					z_id = id_list[0]
-					a_id = id_list[1]
-					# Retrieve the animal
-					a_list = []
-					a = ndb.Key(urlsafe=a_id).get()
-					if a.user_id == user_id:
-						a_dict = a.to_dict()
-						a_dict['self'] = '/animals/' + a.key.urlsafe()
-						a_list.append(a_dict)
-						self.response.write(json.dumps(a_list))
-					else:
-						self.response.write("ERROR: Not authorized")
-					
-				# /zoos/:zooid -- GET request will return information of an individual zoo
+		# If there is an id
+		if id:
+			# /zoo/:zooid/animals -- GET request will return an array of full JSON animals entries
+			if id.endswith("/animals"):
+				z_id = id.replace("/animals", "")
+				user_id = self.user_id
+				z = self.get_owned(z_id, Zoo)
+				if z is not None:
+					# One batched lookup for exactly the animals the zoo references
+					zoo_animals = ndb.get_multi_async([k for k in z.animal_keys() if not foreign_key(k, user_id)])
+					zoo_animals = [animals.get_result() for animals in zoo_animals]
+					self.write_json_list([animals for animals in zoo_animals if animals is not None and animals.user_id == user_id], animal_to_dict)
 				else:
-					z = ndb.Key(urlsafe=id).get()
-					if z.user_id == user_id:
-						z_d = z.to_dict()
-						# Create a self link using the key as id
-						z_d['self'] = "/zoos/" + id
-						self.response.write(json.dumps(z_d))
-					else:
-						self.response.write("ERROR: Not authorized")
-					
-			# /zoos -- GET request will return all zoos
-			else:
-				all_zoos = Zoo.query().fetch()
-				final_list = []
-				for zoos in all_zoos:
-					if zoos.user_id == user_id:
-						json_zoos = zoos.to_dict()
-						json_zoos['self'] = '/zoos/' + zoos.key.urlsafe()
-						final_list.append(json_zoos)
-				self.response.write(json.dumps(final_list))		
-
-	# DELETE zoo entries ****************************************************************************
-	def delete(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
-		
-			# /zoos/:zooid/animals/:animalid ----- DELETE request will check a animal back in
-			if "/animals" in id:
+					self.response.write("ERROR: Not authorized")
+				
+			# /zoos/:zooid/animals/:animalid
+			elif "/animals/" in id:
 				# Split id to obtain the zoo id and animal id
 				id_list = id.split("/animals/")
 				z_id = id_list[0]
 				a_id = id_list[1]
-				# Retrieve keys of the zoo and animal
-				z = ndb.Key(urlsafe=z_id).get()
-				if z.user_id == user_id:
-					a = ndb.Key(urlsafe=a_id).get()
-					if a.user_id == user_id:
-						# Remove the animal from the zoo's species_list list
-						z.species_list.remove('/animals/' + a.key.urlsafe())
-						# Adjust animal's checked_in to be consistent with species_list
-						a.checked_in=True		
-						a.put()		
-						z.put()
-						self.response.set_status(200)
-					else: 
-						self.response.write("ERROR: Unauthorized command is unable to access the animal entity")
-				else: 
-					self.response.write("ERROR: Unauthorized command is unable to access the zoo entity")
-					
-			else: 
-				# Retrieve entity
-				z = ndb.Key(urlsafe=id).get()	
-				if z.user_id == user_id:
-					animal_list = Animal.query().fetch()
-					
-					book_keys = []
-					# Loop through all zoo's species_list animals to set checked_in to True
-					for animals in z.species_list:
-						animals = animals.replace("/animals/", "")
-						for animal_list_animals in animal_list:
-							if animal_list_animals.key.urlsafe() == animals:
-								animal_list_animals.checked_in = True
-								animal_list_animals.put()							
-					# Delete the zoo
-					z.key.delete()	
-					# Set code 204
-					self.response.set_status(204)		
+				# Retrieve the animal
+				a_list = []
+				a = self.get_owned(a_id, Animal)
+				if a is not None:
+					a_list.append(animal_to_dict(a))
+					self.write_json(a_list)
 				else:
-					self.response.write("ERROR: Unauthorized command")
+					self.response.write("ERROR: Not authorized")
+				
+			# /zoos/:zooid -- GET request will return information of an individual zoo
+			else:
+				if not self.write_cached_entity(self.entity_key(id, Zoo), zoo_to_dict):
+					self.response.write("ERROR: Not authorized")
+				
+		# /zoos?since=:token -- GET request will return the zoos changed or deleted since then
+		elif self.request.get('since'):
+			self.write_changes(Zoo, zoo_to_dict)
+
+		# /zoos -- GET request will return all zoos
+		else:
+			user_id = self.user_id
+			self.write_page(user_query(Zoo, user_id), zoo_to_dict, ZOO_PROJECTIONS)
+
+	# DELETE zoo entries ****************************************************************************
+	def delete(self, id=None):
+		# /zoos/:zooid/animals/:animalid ----- DELETE request will check a animal back in
+		if "/animals" in id:
+			self.change_membership(id, check_out=False)
+				
+		else: 
+			zoo_key = self.entity_key(id, Zoo)
+			user_id = self.user_id
+			# Check all of the zoo's animals back in and delete the zoo with one batched put and
+			# one delete, committed together. Ownership is checked on the transaction's read
+			def delete_zoo():
+				zoo = zoo_key.get()
+				if zoo is None:
+					return True
+				if not owned_by(zoo, user_id):
+					return False
+				animal_list = [a for a in ndb.get_multi(zoo.animal_keys()) if a is not None]
+				put_counted(check_in(zoo, animal_list), [zoo.key])
+				return True
+			# Another user's id is refused from the key alone, before the transaction
+			if not foreign_key(zoo_key, user_id) and ndb.transaction(delete_zoo, xg=True):
+				# Set code 204
+				self.response.set_status(204)		
+			else:
+				self.response.write("ERROR: Unauthorized command")
 
 	# PUT zoo entries
 	def put(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
+		# /zoos/:zooid/animals/:animalid ----- PUT request will check a animal out to zoo
+		if "/animals/" in id:
+			self.change_membership(id, check_out=True)
+			
 		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
-		
-			# /zoos/:zooid/animals/:animalid ----- PUT request will check a animal out to zoo
-			if "/animals/" in id:
-				# Split id to obtain the zoo id and animal id
-				id_list = id.split("/animals/")
-				z_id = id_list[0]
-				a_id = id_list[1]
-				# Retrieve keys of the zoo and animal
-				z = ndb.Key(urlsafe=z_id).get()
-				if z.user_id == user_id:
-					a = ndb.Key(urlsafe=a_id).get()
-					if a.user_id == user_id:
-						# Add the animal from the zoo's species_list list
-						z.species_list.append('/animals/' + a.key.urlsafe())
-						# Adjust animal's checked_in to be consistent with species_list
-						a.checked_in=False		
-						a.put()		
-						z.put()
-						self.response.set_status(201)
-					else:
-						self.response.write("ERROR: Unauthorized command is unable to access the animal entity")
+			user_id = self.user_id
+			# Send data into json obj
+			zoo_data = jsonutil.loads(self.request.body)
+			
+			# Create list to hold the keys of the animals named in species_list, else fill as NULL
+			animal_keys = []
+			missing = []
+			if zoo_data.get('species_list'):
+				# Match species_list animals with the user's animals in one batched query
+				animal_keys, missing = species_list_keys(user_id, zoo_data['species_list'])
+			
+			# Edits to the zoo as the transaction reads it
+			def edit(z):
+				# If there is a name, update
+				if zoo_data.get('name'):
+					z.name=zoo_data['name']
+				# Else fill as NULL
 				else:
-					self.response.write("ERROR: Unauthorized command is unable to access the zoo entity")
+					z.name=None
 				
-			else:
-				# Retrieve entity
-				z = ndb.Key(urlsafe=id).get()
-				if z.user_id == user_id:
-					# Send data into json obj
-					zoo_data = json.loads(self.request.body)
+				# If there is a city, update
+				if zoo_data.get('city'):
+					z.city=zoo_data['city']
+				# Else fill as NULL
+				else:
+					z.city=None
 					
-					# If there is a name, update
-					if zoo_data.get('name'):
-						z.name=zoo_data['name']
-					# Else fill as NULL
-					else:
-						z.name=None
+				# If there is a state, update
+				if zoo_data.get('state'):
+					z.state=zoo_data['state']
+				# Else fill as NULL
+				else:
+					z.state=None
 					
-					# If there is a city, update
-					if zoo_data.get('city'):
-						z.city=zoo_data['city']
-					# Else fill as NULL
-					else:
-						z.city=None
-						
-					# If there is a state, update
-					if zoo_data.get('state'):
-						z.state=zoo_data['state']
-					# Else fill as NULL
-					else:
-						z.state=None
-						
-					# If there is a size, update
-					if zoo_data.get('size'):
-						z.size=zoo_data['size']
-					# Else fill as NULL
-					else:
-						z.size=None	
-						
-					# If there is a admission, update
-					if zoo_data.get('admission'):
-						z.admission=zoo_data['admission']
-					# Else fill as NULL
-					else:
-						z.admission=None	
-						
-					# If there is a species_list list, update
-					if zoo_data.get('species_list'):
-						# Create list to hold animal links in species_list
-						zoo_animals = []
-						# Loop through all species_list animals passed in PUT request
-						for animals in zoo_data['species_list']:
-							# Match species_list animals with list of animals in database
-							animal_list = Animal.query(Animal.species==animals).get()
-							if animal_list.user_id == user_id:
-								# Add the animal link to zoo_animals
-								zoo_animals.append('/animals/' + animal_list.key.urlsafe())
-								z.species_list=zoo_animals
-								# Adjust animals list of checked_in to be consistent with species_list
-								animal_list.checked_in=False		
-								animal_list.put()					
-							else:
-								self.response.write("ERROR: Unauthorized command is unable to access: " + str(animals) + "<br>")
-					# Else fill as NULL
-					else:
-						z.species_list=[]
-						
-					# Put edits into zoo
-					z.put()
+				# If there is a size, update
+				if zoo_data.get('size'):
+					z.size=zoo_data['size']
+				# Else fill as NULL
+				else:
+					z.size=None	
 					
-					z_dict = z.to_dict()
-					z_dict['self'] = '/zoos/' + z.key.urlsafe()
-					# Dump data back out
-					self.response.write(json.dumps(z_dict))		
+				# If there is a admission, update
+				if zoo_data.get('admission'):
+					z.admission=zoo_data['admission']
+				# Else fill as NULL
 				else:
-					self.response.write("ERROR: Unauthorized command is unable to access the zoo entity")
+					z.admission=None	
+				
+				# Check dropped animals in and listed ones out, as read in the same transaction
+				zoo_animals = [a for a in ndb.get_multi(animal_keys) if owned_by(a, user_id)]
+				return replace_zoo_animals(z, zoo_animals)
+			
+			# Put edits into the caller's zoo, unless they change nothing or If-Match no longer holds
+			z = self.save_edit(id, Zoo, zoo_to_dict, edit)
+			if z is not None:
+				for animals in missing:
+					self.response.write("ERROR: Unauthorized command is unable to access: " + animals + "<br>")
+				# Dump data back out
+				self.write_json(zoo_to_dict(z))
+			else:
+				self.response.write("ERROR: Unauthorized command is unable to access the zoo entity")
 
 	# PATCH zoo entries
 	def patch(self, id=None):
-		# Obtain the authorization token
-		auth_token = AuthToken.query().get()
-		if auth_token is None:
-			self.response.write("ERROR: Not authorized")
-		else:
-			# Flush out user ID field
-			user_id = None
-			# GET request that uses token to access the Google+ account linked with the email login
-			try:
-				result = urlfetch.fetch(
-					url='https://www.googleapis.com/plus/v1/people/me',
-					headers={'Authorization': auth_token.auth_token})
-			except urlfetch.Error:
-				logging.exception('Caught exception fetching url')
-			# Get user ID
-			user_results = json.loads(result.content)
-			user_id = user_results['id']
-		
-			if id:
-				# Retrieve entity
-				z = ndb.Key(urlsafe=id).get()
-				if z.user_id == user_id:
-					# Send data into json obj
-					zoo_data = json.loads(self.request.body)
+		if id:
+			user_id = self.user_id
+			# Send data into json obj
+			zoo_data = jsonutil.loads(self.request.body)
+			
+			# Create list to hold the keys of the animals named in species_list
+			animal_keys = []
+			missing = []
+			if zoo_data.get('species_list'):
+				# Match species_list animals with the user's animals in one batched query
+				animal_keys, missing = species_list_keys(user_id, zoo_data['species_list'])
+			
+			# Edits to the zoo as the transaction reads it
+			def edit(z):
+				# If there is a name, update
+				if zoo_data.get('name'):
+					z.name=zoo_data['name']
 					
-					# If there is a name, update
-					if zoo_data.get('name'):
-						z.name=zoo_data['name']
-						
-					# If there is a city, update
-					if zoo_data.get('city'):
-						z.city=zoo_data['city']
-						
-					# If there is a state, update
-					if zoo_data.get('state'):
-						z.state=zoo_data['state']
-						
-					# If there is a size, update
-					if zoo_data.get('size'):
-						z.size=zoo_data['size']
-						
-					# If there is a admission, update
-					if zoo_data.get('admission'):
-						z.admission=zoo_data['admission']				
-						
-					# If there is a species_list list given, update
-					if zoo_data.get('species_list'):
-						# Create list to hold animal links in species_list
-						zoo_animals = []
-						# Loop through all species_list animals passed in PUT request
-						for animals in zoo_data['species_list']:
-							# Match species_list animals with list of animals in database
-							animal_list = Animal.query(Animal.species==animals).get()
-							if animal_list.user_id == user_id:
-								# Add the animal link to zoo_animals
-								zoo_animals.append('/animals/' + animal_list.key.urlsafe())
-								z.species_list=zoo_animals
-								# Adjust Animals list of checked_in to be consistent with species_list
-								animal_list.checked_in=False		
-								animal_list.put()	
-							else:
-								self.response.write("ERROR: Unauthorized command is unable to access: " + str(animals) + "<br>")
-					# Put edits into zoo
-					z.put()
+				# If there is a city, update
+				if zoo_data.get('city'):
+					z.city=zoo_data['city']
 					
-					z_dict = z.to_dict()
-					z_dict['self'] = '/zoos/' + z.key.urlsafe()
-					# Dump data back out
-					self.response.write(json.dumps(z_dict))			
-				else:
-					self.response.write("ERROR: Not Authorized")
+				# If there is a state, update
+				if zoo_data.get('state'):
+					z.state=zoo_data['state']
+					
+				# If there is a size, update
+				if zoo_data.get('size'):
+					z.size=zoo_data['size']
+					
+				# If there is a admission, update
+				if zoo_data.get('admission'):
+					z.admission=zoo_data['admission']				
+					
+				# If there is a species_list list given, check its animals out as read in the same transaction
+				if zoo_data.get('species_list'):
+					zoo_animals = [a for a in ndb.get_multi(animal_keys) if owned_by(a, user_id)]
+					return replace_zoo_animals(z, zoo_animals)
+				return []
+			
+			# Put edits into the caller's zoo, unless they change nothing or If-Match no longer holds
+			z = self.save_edit(id, Zoo, zoo_to_dict, edit)
+			if z is not None:
+				for animals in missing:
+					self.response.write("ERROR: Unauthorized command is unable to access: " + animals + "<br>")
+				# Dump data back out
+				self.write_json(zoo_to_dict(z))
+			else:
+				self.response.write("ERROR: Not Authorized")
+
+
+class AnimalBatchHandler(ApiHandler):
+	# POST a JSON array or NDJSON stream of animals. Nothing is written unless every item is valid
+	def post(self):
+		user_id = self.user_id
+		items = self.read_batch()
+		if items is None:
+			return
+		errors = [{'index': index, 'status': 400, 'error': error} for index, error in enumerate(map(animal_batch_error, items)) if error]
+		if errors:
+			self.response.set_status(400)
+			self.response.write(jsonutil.dumps(errors))
+			return
+
+		# The user's own entity group is the parent of all their animals
+		parent_key = user_key(user_id)
+		new_animals = [Animal(user_id=user_id, species=animal_data['species'], population=animal_data.get('population'), consumption_class=animal_data.get('consumption_class'), checked_in=animal_data.get('checked_in'), parent=parent_key) for animal_data in items]
+		# Insert the animals in transactions of PUT_CHUNK_SIZE entities including the user's stats, so
+		# each chunk is counted in the same commit. The chunks share the user's entity group, so they
+		# run one after another; a failed one fails only its own items
+		futures_by_entity = {}
+		for start in range(0, len(new_animals), PUT_CHUNK_SIZE - 1):
+			chunk = new_animals[start:start + PUT_CHUNK_SIZE - 1]
+			future = ndb.transaction_async(lambda: put_counted(chunk), xg=True)
+			future.wait()
+			for animal in chunk:
+				futures_by_entity[id(animal)] = future
+		self.write_batch_results([[animal] for animal in new_animals], futures_by_entity, '/animals/')
+
+
+class ZooBatchHandler(ApiHandler):
+	# POST a JSON array or NDJSON stream of zoos. species_list names are checked out to the new
+	# zoos. Nothing is written unless every item is valid
+	def post(self):
+		user_id = self.user_id
+		items = self.read_batch()
+		if items is None:
+			return
+		errors = [{'index': index, 'status': 400, 'error': error} for index, error in enumerate(map(zoo_batch_error, items)) if error]
+		if errors:
+			self.response.set_status(400)
+			self.response.write(jsonutil.dumps(errors))
+			return
+
+		# Resolve every species name in the batch up front, to keys only: the animals are read again in
+		# the transaction that checks them out. An animal can only be checked out to one zoo
+		names = [name for zoo_data in items if zoo_data.get('species_list') not in (None, "[]") for name in zoo_data['species_list']]
+		animals_by_species = find_animals_by_species(user_id, names)
+		claimed = set()
+		zoo_animal_keys = []
+		for index, zoo_data in enumerate(items):
+			item_keys = []
+			if zoo_data.get('species_list') not in (None, "[]"):
+				for name in zoo_data['species_list']:
+					animal = animals_by_species.get(name)
+					if animal is None:
+						errors.append({'index': index, 'status': 404, 'error': "ERROR: No animal of species " + name})
+					elif animal.key in claimed:
+						errors.append({'index': index, 'status': 409, 'error': "ERROR: " + name + " is listed by more than one zoo in the batch"})
+					else:
+						claimed.add(animal.key)
+						item_keys.append(animal.key)
+			zoo_animal_keys.append(item_keys)
+		if errors:
+			self.response.set_status(400)
+			self.response.write(jsonutil.dumps(errors))
+			return
+
+		# The user's own entity group is the parent of all their zoos, allocating keys so animals can point back
+		parent_key = user_key(user_id)
+		first_id, _ = Zoo.allocate_ids(size=len(items), parent=parent_key)
+		new_zoos = [Zoo(user_id=user_id, name=zoo_data['name'], city=zoo_data.get('city'), state=zoo_data.get('state'), size=zoo_data.get('size'), admission=zoo_data.get('admission'), id=first_id + index, parent=parent_key) for index, zoo_data in enumerate(items)]
+
+		# Split the items into transactions of at most PUT_CHUNK_SIZE entities: each zoo, its animals and
+		# the zoo each animal may be moved away from, plus the user's stats
+		chunks = [[]]
+		chunk_size = 1
+		for index, item_keys in enumerate(zoo_animal_keys):
+			item_size = 1 + 2 * len(item_keys)
+			if chunks[-1] and chunk_size + item_size > PUT_CHUNK_SIZE:
+				chunks.append([])
+				chunk_size = 1
+			chunks[-1].append(index)
+			chunk_size += item_size
+
+		# Insert the zoos and check their animals out, as read in the same transaction. The chunks share
+		# the user's entity group, so they run one after another; a failed one fails only its own items
+		futures_by_entity = {}
+		for chunk in chunks:
+			def create_zoos(chunk=chunk):
+				animal_keys = [k for index in chunk for k in zoo_animal_keys[index]]
+				animals = dict(zip(animal_keys, ndb.get_multi(animal_keys)))
+				# A zoo the animals are moved away from may be shared by several items, write it only once
+				to_put = collections.OrderedDict()
+				for index in chunk:
+					new_zoo = new_zoos[index]
+					item_animals = [animals[k] for k in zoo_animal_keys[index] if owned_by(animals[k], user_id)]
+					for entity in [new_zoo] + check_out(new_zoo, item_animals):
+						to_put[entity.key] = entity
+				put_counted(to_put.values())
+			future = ndb.transaction_async(create_zoos, xg=True)
+			future.wait()
+			for index in chunk:
+				futures_by_entity[id(new_zoos[index])] = future
+		self.write_batch_results([[new_zoo] for new_zoo in new_zoos], futures_by_entity, '/zoos/')
+
+
+class StatsHandler(ApiHandler):
+	# GET the caller's animal and zoo totals, kept up to date by every write
+	def get(self):
+		user_id = self.user_id
+		stats = ndb.Key(UserStats, user_id).get() or UserStats()
+		self.write_json(stats_to_dict(stats))
 
 
 class DeleteAllHandler(webapp2.RequestHandler):
+	# toplevel so the cache invalidations queued by the delete hooks are flushed
+	@ndb.toplevel
 	def delete(self, id=None):
+		# Everyone with a zoo or animal has list pages cached that are about to be wrong
+		owners = set(e.user_id for model in (Animal, Zoo) for e in model.query(projection=[model.user_id], distinct=True))
+
 		# Delete all books in the database	
 		all_animals = Animal.query().fetch(keys_only=True)
 		ndb.delete_multi(all_animals)
@@ -784,21 +1858,56 @@ class DeleteAllHandler(webapp2.RequestHandler):
 		# Delete all customers in the database
 		all_zoos = Zoo.query().fetch(keys_only=True)
 		ndb.delete_multi(all_zoos)
+
+		# Nothing left to count, point at or report
+		ndb.delete_multi(UserStats.query().fetch(keys_only=True))
+		ndb.delete_multi(KeyAlias.query().fetch(keys_only=True))
+		ndb.delete_multi(Tombstone.query().fetch(keys_only=True))
+		for user_id in owners:
+			bump_list_generation(user_id)
 		
 		self.response.set_status(204)
 
+class MigrationHandler(webapp2.RequestHandler):
+	def get(self):
+		# Kick off the zoo link migration on the task queue (admin only, see app.yaml)
+		deferred.defer(migrate_zoo_links)
+		self.response.write("Zoo migration queued.")
+
+class KeyspaceMigrationHandler(webapp2.RequestHandler):
+	def get(self):
+		# Move legacy zoos and animals into per-user entity groups on the task queue (admin only, see app.yaml)
+		deferred.defer(migrate_keyspace)
+		self.response.write("Keyspace migration queued.")
+
+class BackfillUpdatedHandler(webapp2.RequestHandler):
+	def get(self):
+		# Timestamp entities from before the change feed on the task queue (admin only, see app.yaml)
+		deferred.defer(backfill_updated)
+		self.response.write("Updated backfill queued.")
+
+class StatsRebuildHandler(webapp2.RequestHandler):
+	def get(self):
+		# Recount every user's stats on the task queue (admin only, see app.yaml)
+		deferred.defer(rebuild_stats)
+		self.response.write("Stats rebuild queued.")
+
+class CacheStatsHandler(webapp2.RequestHandler):
+	def get(self):
+		# Hit and miss counts of this instance's entity JSON cache (admin only, see app.yaml)
+		self.response.headers['Content-Type'] = 'application/json'
+		self.response.write(jsonutil.dumps(entity_cache.stats()))
+
 class LogOutHandler(webapp2.RequestHandler):
 	def get(self):
-		# Delete any stray authentication tokens that may be stored
-		all_tokens = AuthToken.query().fetch(keys_only=True)
-		ndb.delete_multi(all_tokens)
+		# Delete only the token the caller is presenting, other users stay logged in
+		auth_token = request_token(self.request)
+		if auth_token:
+			forget_identity(auth_token)
 		self.response.write("You have been logged out.")
 
 class MainPage(webapp2.RequestHandler):
 	def get(self):
-		# Delete any stray authentication tokens that may be stored
-		all_tokens = AuthToken.query().fetch(keys_only=True)
-		ndb.delete_multi(all_tokens)
 		# Notify user they are being redirected to login
 		self.response.write("Welcome to class CS 496: Final Project - Cloud Only Implementation!! <br/>")
 		self.response.write("It seems you have not logged in. Please press the Log In button to be redirected to authorize login credentials via Google+")
@@ -818,11 +1927,19 @@ app = webapp2.WSGIApplication([
 	('/oauth', OauthHandler),
 	('/login/', LogInHandler),
 	('/logout', LogOutHandler),
+	('/zoos:batch', ZooBatchHandler),					# POST many zoos at once
+	('/animals:batch', AnimalBatchHandler),				# POST many animals at once
 	('/zoos', ZooHandler),
 	('/zoos/(.*)', ZooHandler),
 	('/animals', AnimalHandler),
 	('/animals/(.*)', AnimalHandler),
 	('/animals?checkedIn=(.*)', AnimalHandler),			# GET list of all checked in/out animals
+	('/stats', StatsHandler),							# GET the caller's animal and zoo totals
+	('/tasks/migrate_zoos', MigrationHandler),
+	('/tasks/rebuild_stats', StatsRebuildHandler),
+	('/tasks/migrate_keyspace', KeyspaceMigrationHandler),
+	('/tasks/backfill_updated', BackfillUpdatedHandler),
+	('/admin/cache_stats', CacheStatsHandler),
 	('/delete', DeleteAllHandler),						# PURELY FOR TESTING, NO AUTHORIZATION NEEDED
 ], debug=True)
 